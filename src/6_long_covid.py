@@ -81,651 +81,928 @@
 '''
 
 from classes.Dataset import Dataset
-from nf_covid.utils.utils import get_core_ref, roots
-from db_queries import get_population
-import datetime, copy
+from nf_covid.utils.utils import check_compression, get_core_ref, roots
+from db_queries import get_age_weights, get_population
+from concurrent.futures import ThreadPoolExecutor
+from estimate_resources import StageTimer, get_run_options, record_run
+import calendar, datetime, functools, json, os
 import numpy as np
 import pandas as pd
 import warnings
 warnings.filterwarnings("ignore")
 
 
-def calc_prev(df, dp, dst_population, dst_outcome, calc_col_stub):
+# Merge keys for daily datasets
+KEYS = ['location_id', 'age_group_id', 'sex_id', 'draw_var', 'date']
+
+# Long-term symptom clusters and their column stubs
+OUTCOMES = {'cognitive' : 'cog', 
+            'fatigue' : 'fat', 
+            'respiratory' : 'resp', 
+            'cognitive_fatigue' : 'cog_fat', 
+            'cognitive_respiratory' : 'cog_resp', 
+            'fatigue_respiratory' : 'fat_resp', 
+            'cognitive_fatigue_respiratory' : 'cog_fat_resp'}
+
+
+def sample_param(mean, lower, upper, n_draws, rng, dist):
+    ''' Sample parameter draws matching a mean and 95% UI
+    Arguments:
+        mean : float
+        lower : float
+        upper : float
+        n_draws : int
+        rng : NumPy Generator
+        dist : str
+            'beta' for proportions, 'gamma' for durations
+    '''
+    se = (upper - lower) / (2 * 1.96)
+    if not se > 0:
+        return(np.full(n_draws, mean))
+
+    if dist == 'beta':
+        k = mean * (1 - mean) / se**2 - 1
+        return(rng.beta(mean * k, (1 - mean) * k, size=n_draws))
+    elif dist == 'gamma':
+        return(rng.gamma((mean / se)**2, se**2 / mean, size=n_draws))
+    raise ValueError('Unknown distribution {}'.format(dist))
+
+
+def get_params(dp, draws=None, param_draws=None, seed=0):
+    ''' Build proportion and duration parameters for each population / outcome.
+        Values are scalars for the mean-only path, or vectors ordered by draws.
+    Arguments:
+        dp : Pandas DataFrame
+        draws : list (optional)
+            Ordered draw_var names, required if param_draws is given
+        param_draws : str or Pandas DataFrame (optional)
+            None to use proportion_mean / duration_mean, 'sample' to sample 
+            draws from the _mean / _lower / _upper columns of dp, or a 
+            pre-drawn table (or path to one) with population, outcome, 
+            draw_var, proportion and duration columns
+        seed : int
+            Fixed by default so every location shares the same parameter draws
+    '''
+    params = {}
+    dp = dp.drop_duplicates(['population', 'outcome'])
+
+    if param_draws is None:
+        for row in dp.itertuples():
+            params[(row.population, row.outcome)] = {'proportion' : row.proportion_mean, 
+                                                     'duration' : row.duration_mean}
+    elif isinstance(param_draws, str) and param_draws == 'sample':
+        rng = np.random.default_rng(seed)
+        for row in dp.itertuples():
+            params[(row.population, row.outcome)] = {
+                'proportion' : sample_param(row.proportion_mean, row.proportion_lower, 
+                                            row.proportion_upper, len(draws), rng, 'beta'),
+                'duration' : sample_param(row.duration_mean, row.duration_lower, 
+                                          row.duration_upper, len(draws), rng, 'gamma')
+                }
+    else:
+        if isinstance(param_draws, str):
+            param_draws = pd.read_csv(param_draws)
+        for (population, outcome), g in param_draws.groupby(['population', 'outcome']):
+            g = g.set_index('draw_var').reindex(draws)
+            if g[['proportion', 'duration']].isnull().values.any():
+                raise ValueError('Missing parameter draws for {} {}'.format(population, outcome))
+            params[(population, outcome)] = {'proportion' : g.proportion.to_numpy(), 
+                                             'duration' : g.duration.to_numpy()}
+
+    return(params)
+
+
+def get_param(params, dst_population, dst_outcome, measure, draw_idx=None):
+    ''' Pull a parameter, broadcasting per-draw vectors along the draw axis
+    Arguments:
+        params : dict
+        dst_population : str
+        dst_outcome : str
+        measure : str
+            'proportion' or 'duration'
+        draw_idx : NumPy array (optional)
+            Position of each row's draw, from Dataset.draw_index
+    '''
+    value = params[(dst_population, dst_outcome)][measure]
+    if np.ndim(value) == 0:
+        return(value)
+    return(value[draw_idx])
+
+
+def calc_prev(df, params, dst_population, dst_outcome, calc_col_stub, draw_idx=None):
     ''' Convenience function to calculate prevalence considering duration scaling
     Arguments:
         df : Pandas DataFrame
-        dp : Pandas DataFrame
+        params : dict
         dst_population : str
         dst_outcome : str
         calc_col_stub : str
+        draw_idx : NumPy array (optional)
     '''
     # Setup durations
-    EOY = datetime.datetime(2020, 12, 31)
-    durs = pd.DataFrame({
-        'date' : df.date.unique(),
-        'duration_mean' : pd.to_timedelta(round(dp.loc[(dp.outcome==dst_outcome) & 
-                                                       (dp.population==dst_population), 
-                                                       'duration_mean'].values[0] * 366), 
-                                          unit='D')
-        })
-
-    # EOY duration scaling
-    durs['new_duration'] = EOY - durs.date
-    durs.loc[durs.new_duration < durs.duration_mean, 
-             'duration_mean'] = durs.new_duration
-    durs.loc[durs.duration_mean < pd.to_timedelta(0, unit='D'), 
-             'duration_mean'] = pd.to_timedelta(0, unit='D')
-    durs.drop(columns='new_duration', inplace=True)
-    durs.duration_mean = durs.duration_mean.dt.days
-
-    # Merge durations with input data
-    df = pd.merge(df, durs, on='date', how='left')
+    duration = np.round(get_param(params, dst_population, dst_outcome, 
+                                  'duration', draw_idx) * 366)
+
+    # EOY duration scaling, durations are truncated at the end of each date's year
+    new_duration = ((365 + df.date.dt.is_leap_year) - df.date.dt.dayofyear).to_numpy()
+    duration = np.clip(np.minimum(duration, new_duration), 0, None)
 
     # Calculate prevalence
     df['{}prev'.format(calc_col_stub)] = (df['{}inc'.format(calc_col_stub)] * 
-                                          df.duration_mean)
-    df.drop(columns='duration_mean', inplace=True)
+                                          duration)
     return(df)
 
 
-def main(loc_id, loc_name, output_version):
-    print('Reading in short-term outcomes...')
-    ## Read in short-term outcomes
-    # region -------------------------------------------------------------------
-    
-    # Durations and proportions
-    dp = pd.read_csv('{}WORK/12_bundle/covid/data/long_covid/long_covid_proportions_durations_with_overlaps.csv'.format(roots['j']))
-    
-    # Mild/Moderate
-    print('  mild/moderate...')
-    midmod = Dataset(loc_id, loc_name, output_version, 'midmod', nf_type='long')
-    
-    # Hospital
-    print('  hospital...')
-    hospital = Dataset(loc_id, loc_name, output_version, 'hsp_admit', nf_type='long')
-
-    # Icu
-    print('  icu...')
-    icu = Dataset(loc_id, loc_name, output_version, 'icu_admit', nf_type='long')
-
-    # endregion ----------------------------------------------------------------
-    
-
-    print('Calculating mild/moderate incidence & prevalence...')
-    ## Mild/Moderate Incidence & Prevalence
-    # region -------------------------------------------------------------------
-    # Shift hospitalizations 7 days
-    lag_hsp = copy.deepcopy(hospital)
-    lag_hsp.data = lag_hsp.data.drop(columns=['hospital_deaths'])
-    lag_hsp.data.date = lag_hsp.data.date + pd.to_timedelta(roots['defaults']['symp_to_hsp_admit_duration'], unit='D')
-
-
-    # Merge midmod and lag_hsp
-    midmod.data = pd.merge(midmod.data, lag_hsp.data, how='left',
-                           on=['location_id', 'age_group_id', 'sex_id', 
-                               'draw_var', 'date'])
-    del lag_hsp
-    
-
-    # mild/moderate at risk number = (mild/moderate incidence - hospital admissions|7 days later) |
-    #                                 shift forward by {incubation period + mild/moderate duration|no hospital}
-    midmod.data['midmod_risk_num'] = midmod.data.midmod_inc - midmod.data.hospital_inc
-    midmod.data.date = midmod.data.date + pd.to_timedelta((roots['defaults']['incubation_period'] + 
-                                                           roots['defaults']['midmod_duration_no_hsp']), unit='D')
-
-
+def calc_long_term(df, params, dst_population, calc_col_stub, risk_col, draw_idx=None):
+    ''' Calculate mutually exclusive long-term incidence and prevalence of 
+        each symptom cluster from a number at risk
+    Arguments:
+        df : Pandas DataFrame
+        params : dict
+        dst_population : str
+        calc_col_stub : str
+        risk_col : str
+        draw_idx : NumPy array (optional)
+    '''
     # Calculate the incidence of each symptom and overlap, regardless of co-occurrence of additional symptoms (not mutually exclusive)
-    # mild/moderate long-term incidence = mild/moderate number at risk * proportion of mild/moderate with each long-term symptom cluster
-    midmod.data['midmod_cog_inc'] = (midmod.data.midmod_risk_num * 
-                                     dp.loc[(dp.outcome=='cognitive') & 
-                                            (dp.population=='midmod'), 
-                                            'proportion_mean'].values[0])
-    midmod.data['midmod_fat_inc'] = (midmod.data.midmod_risk_num * 
-                                     dp.loc[(dp.outcome=='fatigue') & 
-                                            (dp.population=='midmod'), 
-                                            'proportion_mean'].values[0])
-    midmod.data['midmod_resp_inc'] = (midmod.data.midmod_risk_num * 
-                                      dp.loc[(dp.outcome=='respiratory') & 
-                                             (dp.population=='midmod'), 
-                                             'proportion_mean'].values[0])
-    midmod.data['midmod_cog_fat_inc'] = (midmod.data.midmod_risk_num *
-                                         dp.loc[(dp.outcome=='cognitive_fatigue') & 
-                                                (dp.population=='midmod'), 
-                                                'proportion_mean'].values[0])
-    midmod.data['midmod_cog_resp_inc'] = (midmod.data.midmod_risk_num *
-                                          dp.loc[(dp.outcome=='cognitive_respiratory') & 
-                                                 (dp.population=='midmod'), 
-                                                 'proportion_mean'].values[0])
-    midmod.data['midmod_fat_resp_inc'] = (midmod.data.midmod_risk_num *
-                                          dp.loc[(dp.outcome=='fatigue_respiratory') & 
-                                                 (dp.population=='midmod'), 
-                                                 'proportion_mean'].values[0])
-    midmod.data['midmod_cog_fat_resp_inc'] = (midmod.data.midmod_risk_num *
-                                              dp.loc[(dp.outcome=='cognitive_fatigue_respiratory') & 
-                                                     (dp.population=='midmod'), 
-                                                     'proportion_mean'].values[0])
+    # long-term incidence = number at risk * proportion with each long-term symptom cluster
+    for outcome, short in OUTCOMES.items():
+        df['{}{}_inc'.format(calc_col_stub, short)] = (df[risk_col] * 
+                                                       get_param(params, dst_population, outcome, 
+                                                                 'proportion', draw_idx))
+
+    cog, fat, resp, cog_fat, cog_resp, fat_resp, cog_fat_resp = [
+        '{}{}_inc'.format(calc_col_stub, short) for short in OUTCOMES.values()]
 
     # Creating mutually exclusive categories of symptoms
     # cog_inc = cog_inc - (cog_fat_inc - cog_fat_resp_inc) - (cog_resp_inc - cog_fat_resp_inc) - cog_fat_resp_inc
-    midmod.data.midmod_cog_inc = (midmod.data.midmod_cog_inc - 
-                                  (midmod.data.midmod_cog_fat_inc - midmod.data.midmod_cog_fat_resp_inc) - 
-                                  (midmod.data.midmod_cog_resp_inc - midmod.data.midmod_cog_fat_resp_inc) - 
-                                  midmod.data.midmod_cog_fat_resp_inc)
+    df[cog] = (df[cog] - (df[cog_fat] - df[cog_fat_resp]) - 
+               (df[cog_resp] - df[cog_fat_resp]) - df[cog_fat_resp])
 
     # fat_inc = fat_inc - (cog_fat_inc - cog_fat_resp_inc) -  (fat_resp_inc - cog_fat_resp_inc) - cog_fat_resp_inc
-    midmod.data.midmod_fat_inc = (midmod.data.midmod_fat_inc - 
-                                  (midmod.data.midmod_cog_fat_inc - midmod.data.midmod_cog_fat_resp_inc) - 
-                                  (midmod.data.midmod_fat_resp_inc - midmod.data.midmod_cog_fat_resp_inc) - 
-                                  midmod.data.midmod_cog_fat_resp_inc)
+    df[fat] = (df[fat] - (df[cog_fat] - df[cog_fat_resp]) - 
+               (df[fat_resp] - df[cog_fat_resp]) - df[cog_fat_resp])
 
     # resp_inc = resp_inc - (fat_resp_inc - cog_fat_resp_inc) - (cog_resp_inc - cog_fat_resp_inc) - cog_fat_resp_inc
-    midmod.data.midmod_resp_inc = (midmod.data.midmod_resp_inc - 
-                                   (midmod.data.midmod_fat_resp_inc - midmod.data.midmod_cog_fat_resp_inc) - 
-                                   (midmod.data.midmod_cog_resp_inc - midmod.data.midmod_cog_fat_resp_inc) - 
-                                   midmod.data.midmod_cog_fat_resp_inc)
+    df[resp] = (df[resp] - (df[fat_resp] - df[cog_fat_resp]) - 
+                (df[cog_resp] - df[cog_fat_resp]) - df[cog_fat_resp])
 
     # cog_fat_inc = cog_fat_inc - cog_fat_resp_inc
-    midmod.data.midmod_cog_fat_inc = (midmod.data.midmod_cog_fat_inc - midmod.data.midmod_cog_fat_resp_inc)
-    
+    df[cog_fat] = df[cog_fat] - df[cog_fat_resp]
+
     # cog_resp_inc = cog_resp_inc - cog_fat_resp_inc
-    midmod.data.midmod_cog_resp_inc = (midmod.data.midmod_cog_resp_inc - midmod.data.midmod_cog_fat_resp_inc)
-    
+    df[cog_resp] = df[cog_resp] - df[cog_fat_resp]
+
     # fat_resp_inc = fat_resp_inc - cog_fat_resp_inc
-    midmod.data.midmod_fat_resp_inc = (midmod.data.midmod_fat_resp_inc - midmod.data.midmod_cog_fat_resp_inc)
+    df[fat_resp] = df[fat_resp] - df[cog_fat_resp]
 
-    
-    # mild/moderate long-term prevalence = mild/moderate long-term incidence * [duration]
-    midmod.data = calc_prev(df=midmod.data, dp=dp, dst_population='midmod', 
-                       dst_outcome='cognitive', calc_col_stub='midmod_cog_')
-    midmod.data = calc_prev(df=midmod.data, dp=dp, dst_population='midmod', 
-                       dst_outcome='fatigue', calc_col_stub='midmod_fat_')
-    midmod.data = calc_prev(df=midmod.data, dp=dp, dst_population='midmod', 
-                       dst_outcome='respiratory', calc_col_stub='midmod_resp_')
-    midmod.data = calc_prev(df=midmod.data, dp=dp, dst_population='midmod', 
-                       dst_outcome='cognitive_fatigue', calc_col_stub='midmod_cog_fat_')
-    midmod.data = calc_prev(df=midmod.data, dp=dp, dst_population='midmod', 
-                       dst_outcome='cognitive_respiratory', calc_col_stub='midmod_cog_resp_')
-    midmod.data = calc_prev(df=midmod.data, dp=dp, dst_population='midmod', 
-                       dst_outcome='fatigue_respiratory', calc_col_stub='midmod_fat_resp_')
-    midmod.data = calc_prev(df=midmod.data, dp=dp, dst_population='midmod', 
-                       dst_outcome='cognitive_fatigue_respiratory', 
-                       calc_col_stub='midmod_cog_fat_resp_')
 
+    # long-term prevalence = long-term incidence * [duration]
+    for outcome, short in OUTCOMES.items():
+        df = calc_prev(df=df, params=params, dst_population=dst_population, 
+                       dst_outcome=outcome, calc_col_stub='{}{}_'.format(calc_col_stub, short), 
+                       draw_idx=draw_idx)
 
-    # Drop unneeded cols
-    midmod.data = midmod.data.drop(columns=['midmod_inc', 'hospital_inc', 'midmod_risk_num'])
+    return(df)
 
-    # endregion ----------------------------------------------------------------
 
+@functools.lru_cache(maxsize=None)
+def read_table(path):
+    ''' Read a shared reference table (proportions / durations, disability
+        weights). Cached so a long-lived worker reads each table once; callers
+        must not modify the result.
+    Arguments:
+        path : str
+    '''
+    return(pd.read_csv(path))
 
-    print('Calculating severe incidence and prevalence...')
-    ## Severe Incidence & Prevalence
-    # region -------------------------------------------------------------------
 
-    # Shift icu admissions
-    lag_icu = copy.deepcopy(icu)
-    lag_icu.data = lag_icu.data.drop(columns=['icu_deaths'])
-    lag_icu.data.date = lag_icu.data.date + pd.to_timedelta(roots['defaults']['icu_to_death_duration'], unit='D')
+def get_input_window(start_date, end_date, defaults=None):
+    ''' Input dates that can shift into [start_date, end_date]. The window is
+        padded on both sides by the longest chain of lags applied in main().
+    Arguments:
+        start_date : datetime
+        end_date : datetime
+        defaults : dict (optional)
+            Durations to use in place of roots['defaults']
+    '''
+    d = roots['defaults'] if defaults is None else defaults
+    max_lag = max(
+        # mild/moderate: hospital lag + shift to long-term onset
+        d['symp_to_hsp_admit_duration'] + d['incubation_period'] + d['midmod_duration_no_hsp'],
+        # severe: icu / hospital death lags + shift to long-term onset
+        max(d['icu_to_death_duration'], d['hsp_no_icu_death_duration']) + 
+        d['hsp_no_icu_no_death_duration'] + d['hsp_midmod_after_discharge_duration'],
+        # critical: icu death lag + shift to long-term onset
+        d['icu_to_death_duration'] + d['icu_no_death_duration'] + 
+        d['icu_midmod_after_discharge_duration'])
+
+    pad = pd.to_timedelta(max_lag, unit='D')
+    return((start_date - pad, end_date + pad))
+
+
+def get_year_window(year, defaults=None):
+    ''' Input dates whose long-term onset (after the shift applied to each 
+        severity in main()) falls in year. Inputs with no dates in this 
+        window cannot produce outputs for the year.
+    Arguments:
+        year : int
+        defaults : dict (optional)
+            Durations to use in place of roots['defaults']
+    '''
+    d = roots['defaults'] if defaults is None else defaults
+    shifts = [d['incubation_period'] + d['midmod_duration_no_hsp'], 
+              d['hsp_no_icu_no_death_duration'] + d['hsp_midmod_after_discharge_duration'], 
+              -(d['icu_no_death_duration'] + d['icu_midmod_after_discharge_duration'])]
+    return((datetime.datetime(year, 1, 1) - pd.to_timedelta(max(shifts), unit='D'), 
+            datetime.datetime(year, 12, 31) - pd.to_timedelta(min(shifts), unit='D')))
+
+
+def get_scenarios(scenarios=None):
+    ''' Build the list of parameter sets to evaluate. Each scenario is a row
+        with a 'scenario' name, optional 'dp_path' to an alternate proportions
+        / durations csv, and any roots['defaults'] keys to override. Blank
+        values fall back to roots['defaults'].
+    Arguments:
+        scenarios : str or Pandas DataFrame (optional)
+            None runs the defaults as a single, untagged scenario
+    '''
+    if scenarios is None:
+        return([{'scenario' : None, 'dp_path' : None, 
+                 'defaults' : dict(roots['defaults'])}])
+
+    if isinstance(scenarios, str):
+        scenarios = pd.read_csv(scenarios)
+
+    unknown = [c for c in scenarios.columns 
+               if c not in ['scenario', 'dp_path'] + list(roots['defaults'].keys())]
+    if unknown:
+        raise ValueError('Unknown scenario parameters: {}'.format(', '.join(unknown)))
+
+    out = []
+    for row in scenarios.to_dict('records'):
+        defaults = dict(roots['defaults'])
+        defaults.update({k : v for k, v in row.items() 
+                         if k in defaults and not pd.isnull(v)})
+        dp_path = row.get('dp_path')
+        out.append({'scenario' : str(row['scenario']), 
+                    'dp_path' : None if pd.isnull(dp_path) else dp_path, 
+                    'defaults' : defaults})
+    return(out)
+
+
+def calc_midmod(midmod, hospital, params, defaults, draws=None, cache=False):
+    ''' Mild/moderate long-term incidence & prevalence
+    Arguments:
+        midmod : Dataset
+        hospital : Dataset
+        params : dict
+        defaults : dict
+        draws : list (optional)
+            Ordered draw_var names if params hold per-draw vectors
+        cache : bool
+            Keep lagged copies for reuse across scenarios
+    '''
+    print('  mild/moderate...')
 
+    # Merge midmod and hospitalizations shifted 7 days
+    df = midmod.merge_shifted([(hospital, ['hospital_inc'], 
+                                defaults['symp_to_hsp_admit_duration'])], cache=cache)
+    
 
-    # Shift hospital deaths
-    lag_hsp = copy.deepcopy(hospital)
-    lag_hsp.data = lag_hsp.data.drop(columns=['hospital_inc'])
-    lag_hsp.data.date = lag_hsp.data.date + pd.to_timedelta(roots['defaults']['hsp_no_icu_death_duration'], unit='D')
+    # mild/moderate at risk number = (mild/moderate incidence - hospital admissions|7 days later) |
+    #                                 shift forward by {incubation period + mild/moderate duration|no hospital}
+    df['midmod_risk_num'] = df.midmod_inc - df.hospital_inc
+    df.date = df.date + pd.to_timedelta((defaults['incubation_period'] + 
+                                         defaults['midmod_duration_no_hsp']), unit='D')
 
 
-    # Merge lagged datasets
-    lag = pd.merge(lag_icu.data, lag_hsp.data, how='left',
-                   on=['location_id', 'age_group_id', 'sex_id', 
-                        'draw_var', 'date'])
-    del lag_icu, lag_hsp
-    hospital.data = pd.merge(hospital.data.drop(columns=['hospital_deaths']), 
-                             lag, how='left', on=['location_id', 'age_group_id', 
-                                                  'sex_id', 'draw_var', 'date'])
-    del lag
+    # Calculate mutually exclusive long-term incidence and prevalence of each symptom cluster
+    # mild/moderate long-term incidence = mild/moderate number at risk * proportion of mild/moderate with each long-term symptom cluster
+    # mild/moderate long-term prevalence = mild/moderate long-term incidence * [duration]
+    df = calc_long_term(df=df, params=params, dst_population='midmod', 
+                        calc_col_stub='midmod_', risk_col='midmod_risk_num', 
+                        draw_idx=midmod.draw_index(draws, df) if draws is not None else None)
 
 
-    # severe at risk number = (hospital admissions - ICU admissions|3 days later - hospital deaths|6 days later) |
-    #                          shift forward by {hospital duration if no ICU no death + hospital mild moderate duration after discharge}
-    hospital.data['hospital_risk_num'] = (hospital.data.hospital_inc - hospital.data.icu_inc - 
-                                          hospital.data.hospital_deaths)
-    hospital.data.date = hospital.data.date + pd.to_timedelta((roots['defaults']['hsp_no_icu_no_death_duration'] + 
-                                                               roots['defaults']['hsp_midmod_after_discharge_duration']), unit='D')
+    # Drop unneeded cols
+    return(df.drop(columns=['midmod_inc', 'hospital_inc', 'midmod_risk_num']))
 
 
-    # Calculate the incidence of each symptom and overlap, regardless of co-occurrence of additional symptoms (not mutually exclusive)
-    # severe long-term incidence = severe at risk number * proportion of severe survivors with each long-term symptom cluster
-    hospital.data['hospital_cog_inc'] = (hospital.data.hospital_risk_num * 
-                                         dp.loc[(dp.outcome=='cognitive') & 
-                                                (dp.population=='hospital'), 
-                                                'proportion_mean'].values[0])
-    hospital.data['hospital_fat_inc'] = (hospital.data.hospital_risk_num * 
-                                         dp.loc[(dp.outcome=='fatigue') & 
-                                                (dp.population=='hospital'), 
-                                                'proportion_mean'].values[0])
-    hospital.data['hospital_resp_inc'] = (hospital.data.hospital_risk_num * 
-                                          dp.loc[(dp.outcome=='respiratory') & 
-                                                 (dp.population=='hospital'), 
-                                                 'proportion_mean'].values[0])
-    hospital.data['hospital_cog_fat_inc'] = (hospital.data.hospital_risk_num *
-                                             dp.loc[(dp.outcome=='cognitive_fatigue') & 
-                                                    (dp.population=='hospital'), 
-                                                    'proportion_mean'].values[0])
-    hospital.data['hospital_cog_resp_inc'] = (hospital.data.hospital_risk_num *
-                                              dp.loc[(dp.outcome=='cognitive_respiratory') & 
-                                                     (dp.population=='hospital'), 
-                                                     'proportion_mean'].values[0])
-    hospital.data['hospital_fat_resp_inc'] = (hospital.data.hospital_risk_num *
-                                              dp.loc[(dp.outcome=='fatigue_respiratory') & 
-                                                     (dp.population=='hospital'), 
-                                                     'proportion_mean'].values[0])
-    hospital.data['hospital_cog_fat_resp_inc'] = (hospital.data.hospital_risk_num *
-                                                  dp.loc[(dp.outcome=='cognitive_fatigue_respiratory') & 
-                                                         (dp.population=='hospital'), 
-                                                         'proportion_mean'].values[0])
+def calc_hospital(hospital, icu, params, defaults, draws=None, cache=False):
+    ''' Severe long-term incidence & prevalence
+    Arguments:
+        hospital : Dataset
+        icu : Dataset
+        params : dict
+        defaults : dict
+        draws : list (optional)
+        cache : bool
+    '''
+    print('  severe...')
 
-    # Creating mutually exclusive categories of symptoms
-    # cog_inc = cog_inc - (cog_fat_inc - cog_fat_resp_inc) - (cog_resp_inc - cog_fat_resp_inc) - cog_fat_resp_inc
-    hospital.data.hospital_cog_inc = (hospital.data.hospital_cog_inc - 
-                                      (hospital.data.hospital_cog_fat_inc - hospital.data.hospital_cog_fat_resp_inc) - 
-                                      (hospital.data.hospital_cog_resp_inc - hospital.data.hospital_cog_fat_resp_inc) - 
-                                      hospital.data.hospital_cog_fat_resp_inc)
+    # Merge hospital admissions with shifted icu admissions and hospital deaths
+    df = hospital.merge_shifted([(icu, ['icu_inc'], defaults['icu_to_death_duration']), 
+                                 (hospital, ['hospital_deaths'], 
+                                  defaults['hsp_no_icu_death_duration'])], 
+                                drop=['hospital_deaths'], cache=cache)
 
-    # fat_inc = fat_inc - (cog_fat_inc - cog_fat_resp_inc) -  (fat_resp_inc - cog_fat_resp_inc) - cog_fat_resp_inc
-    hospital.data.hospital_fat_inc = (hospital.data.hospital_fat_inc - 
-                                      (hospital.data.hospital_cog_fat_inc - hospital.data.hospital_cog_fat_resp_inc) - 
-                                      (hospital.data.hospital_fat_resp_inc - hospital.data.hospital_cog_fat_resp_inc) - 
-                                      hospital.data.hospital_cog_fat_resp_inc)
 
-    # resp_inc = resp_inc - (fat_resp_inc - cog_fat_resp_inc) - (cog_resp_inc - cog_fat_resp_inc) - cog_fat_resp_inc
-    hospital.data.hospital_resp_inc = (hospital.data.hospital_resp_inc - 
-                                       (hospital.data.hospital_fat_resp_inc - hospital.data.hospital_cog_fat_resp_inc) - 
-                                       (hospital.data.hospital_cog_resp_inc - hospital.data.hospital_cog_fat_resp_inc) - 
-                                       hospital.data.hospital_cog_fat_resp_inc)
+    # severe at risk number = (hospital admissions - ICU admissions|3 days later - hospital deaths|6 days later) |
+    #                          shift forward by {hospital duration if no ICU no death + hospital mild moderate duration after discharge}
+    df['hospital_risk_num'] = df.hospital_inc - df.icu_inc - df.hospital_deaths
+    df.date = df.date + pd.to_timedelta((defaults['hsp_no_icu_no_death_duration'] + 
+                                         defaults['hsp_midmod_after_discharge_duration']), unit='D')
 
-    # cog_fat_inc = cog_fat_inc - cog_fat_resp_inc
-    hospital.data.hospital_cog_fat_inc = (hospital.data.hospital_cog_fat_inc - hospital.data.hospital_cog_fat_resp_inc)
-    
-    # cog_resp_inc = cog_resp_inc - cog_fat_resp_inc
-    hospital.data.hospital_cog_resp_inc = (hospital.data.hospital_cog_resp_inc - hospital.data.hospital_cog_fat_resp_inc)
-    
-    # fat_resp_inc = fat_resp_inc - cog_fat_resp_inc
-    hospital.data.hospital_fat_resp_inc = (hospital.data.hospital_fat_resp_inc - hospital.data.hospital_cog_fat_resp_inc)
-    
 
+    # Calculate mutually exclusive long-term incidence and prevalence of each symptom cluster
+    # severe long-term incidence = severe at risk number * proportion of severe survivors with each long-term symptom cluster
     # severe long-term prevalence = severe long-term incidence * [duration]
-    hospital.data = calc_prev(df=hospital.data, dp=dp, dst_population='hospital', 
-                       dst_outcome='cognitive', calc_col_stub='hospital_cog_')
-    hospital.data = calc_prev(df=hospital.data, dp=dp, dst_population='hospital', 
-                       dst_outcome='fatigue', calc_col_stub='hospital_fat_')
-    hospital.data = calc_prev(df=hospital.data, dp=dp, dst_population='hospital', 
-                       dst_outcome='respiratory', calc_col_stub='hospital_resp_')
-    hospital.data = calc_prev(df=hospital.data, dp=dp, dst_population='hospital', 
-                       dst_outcome='cognitive_fatigue', calc_col_stub='hospital_cog_fat_')
-    hospital.data = calc_prev(df=hospital.data, dp=dp, dst_population='hospital', 
-                       dst_outcome='cognitive_respiratory', calc_col_stub='hospital_cog_resp_')
-    hospital.data = calc_prev(df=hospital.data, dp=dp, dst_population='hospital', 
-                       dst_outcome='fatigue_respiratory', calc_col_stub='hospital_fat_resp_')
-    hospital.data = calc_prev(df=hospital.data, dp=dp, dst_population='hospital', 
-                       dst_outcome='cognitive_fatigue_respiratory', 
-                       calc_col_stub='hospital_cog_fat_resp_')
+    df = calc_long_term(df=df, params=params, dst_population='hospital', 
+                        calc_col_stub='hospital_', risk_col='hospital_risk_num', 
+                        draw_idx=hospital.draw_index(draws, df) if draws is not None else None)
 
 
     # Remove unneeded cols
-    hospital.data = hospital.data.drop(columns=['hospital_inc', 'icu_inc', 'hospital_deaths', 
-                                                'hospital_risk_num'])
-    
-    # endregion ----------------------------------------------------------------
-
+    return(df.drop(columns=['hospital_inc', 'icu_inc', 'hospital_deaths', 
+                            'hospital_risk_num']))
 
-    print('Calculating critical incidence and prevalence...')
-    ## Critical Incidence & Prevalence
-    # region -------------------------------------------------------------------
-
-    # Shift icu deaths
-    lag_icu = copy.deepcopy(icu)
-    lag_icu.data = lag_icu.data.drop(columns='icu_inc')
-    lag_icu.data.date = lag_icu.data.date + pd.to_timedelta(roots['defaults']['icu_to_death_duration'], unit='D')
 
+def calc_icu(icu, params, defaults, draws=None, cache=False):
+    ''' Critical long-term incidence & prevalence
+    Arguments:
+        icu : Dataset
+        params : dict
+        defaults : dict
+        draws : list (optional)
+        cache : bool
+    '''
+    print('  critical...')
 
-    # Merge icu and lag_icu
-    icu.data = pd.merge(icu.data.drop(columns='icu_deaths'),
-                        lag_icu.data, how='left', on=['location_id', 'age_group_id', 
-                                                      'sex_id', 'draw_var', 'date'])
-    del lag_icu
+    # Merge icu admissions and shifted icu deaths
+    df = icu.merge_shifted([(icu, ['icu_deaths'], defaults['icu_to_death_duration'])], 
+                           drop=['icu_deaths'], cache=cache)
 
 
     # critical at risk number = (ICU admissions - ICU deaths|3 days later) |
     #                            shift forward by {ICU duration if no death + ICU mild moderate duration after discharge}
-    icu.data['icu_risk_num'] = icu.data.icu_inc - icu.data.icu_deaths
-    icu.data.date = icu.data.date - pd.to_timedelta((roots['defaults']['icu_no_death_duration'] + 
-                                                     roots['defaults']['icu_midmod_after_discharge_duration']), unit='D')
+    df['icu_risk_num'] = df.icu_inc - df.icu_deaths
+    df.date = df.date - pd.to_timedelta((defaults['icu_no_death_duration'] + 
+                                         defaults['icu_midmod_after_discharge_duration']), unit='D')
 
 
-    # Calculate the incidence of each symptom and overlap, regardless of co-occurrence of additional symptoms (not mutually exclusive)
+    # Calculate mutually exclusive long-term incidence and prevalence of each symptom cluster
     # critical long-term incidence = critical number at risk * proportion of critical with each long-term symptom cluster
-    icu.data['icu_cog_inc'] = (icu.data.icu_risk_num * 
-                               dp.loc[(dp.outcome=='cognitive') & 
-                                      (dp.population=='icu'), 
-                                      'proportion_mean'].values[0])
-    icu.data['icu_fat_inc'] = (icu.data.icu_risk_num * 
-                               dp.loc[(dp.outcome=='fatigue') & 
-                                      (dp.population=='icu'), 
-                                      'proportion_mean'].values[0])
-    icu.data['icu_resp_inc'] = (icu.data.icu_risk_num * 
-                                dp.loc[(dp.outcome=='respiratory') & 
-                                       (dp.population=='icu'), 
-                                       'proportion_mean'].values[0])
-    icu.data['icu_cog_fat_inc'] = (icu.data.icu_risk_num *
-                                   dp.loc[(dp.outcome=='cognitive_fatigue') & 
-                                          (dp.population=='icu'), 
-                                          'proportion_mean'].values[0])
-    icu.data['icu_cog_resp_inc'] = (icu.data.icu_risk_num *
-                                    dp.loc[(dp.outcome=='cognitive_respiratory') & 
-                                           (dp.population=='icu'), 
-                                           'proportion_mean'].values[0])
-    icu.data['icu_fat_resp_inc'] = (icu.data.icu_risk_num *
-                                    dp.loc[(dp.outcome=='fatigue_respiratory') & 
-                                           (dp.population=='icu'), 
-                                           'proportion_mean'].values[0])
-    icu.data['icu_cog_fat_resp_inc'] = (icu.data.icu_risk_num *
-                                        dp.loc[(dp.outcome=='cognitive_fatigue_respiratory') & 
-                                               (dp.population=='icu'), 
-                                               'proportion_mean'].values[0])
+    # critical long-term prevalence = critical long-term incidence * [duration]
+    df = calc_long_term(df=df, params=params, dst_population='icu', 
+                        calc_col_stub='icu_', risk_col='icu_risk_num', 
+                        draw_idx=icu.draw_index(draws, df) if draws is not None else None)
 
-    # Creating mutually exclusive categories of symptoms
-    # cog_inc = cog_inc - (cog_fat_inc - cog_fat_resp_inc) - (cog_resp_inc - cog_fat_resp_inc) - cog_fat_resp_inc
-    icu.data.icu_cog_inc = (icu.data.icu_cog_inc - 
-                            (icu.data.icu_cog_fat_inc - icu.data.icu_cog_fat_resp_inc) - 
-                            (icu.data.icu_cog_resp_inc - icu.data.icu_cog_fat_resp_inc) - 
-                            icu.data.icu_cog_fat_resp_inc)
 
-    # fat_inc = fat_inc - (cog_fat_inc - cog_fat_resp_inc) -  (fat_resp_inc - cog_fat_resp_inc) - cog_fat_resp_inc
-    icu.data.icu_fat_inc = (icu.data.icu_fat_inc - 
-                            (icu.data.icu_cog_fat_inc - icu.data.icu_cog_fat_resp_inc) - 
-                            (icu.data.icu_fat_resp_inc - icu.data.icu_cog_fat_resp_inc) - 
-                            icu.data.icu_cog_fat_resp_inc)
+    # Remove unneeded cols
+    return(df.drop(columns=['icu_inc', 'icu_deaths', 'icu_risk_num']))
 
-    # resp_inc = resp_inc - (fat_resp_inc - cog_fat_resp_inc) - (cog_resp_inc - cog_fat_resp_inc) - cog_fat_resp_inc
-    icu.data.icu_resp_inc = (icu.data.icu_resp_inc - 
-                             (icu.data.icu_fat_resp_inc - icu.data.icu_cog_fat_resp_inc) - 
-                             (icu.data.icu_cog_resp_inc - icu.data.icu_cog_fat_resp_inc) - 
-                             icu.data.icu_cog_fat_resp_inc)
 
-    # cog_fat_inc = cog_fat_inc - cog_fat_resp_inc
-    icu.data.icu_cog_fat_inc = (icu.data.icu_cog_fat_inc - icu.data.icu_cog_fat_resp_inc)
-    
-    # cog_resp_inc = cog_resp_inc - cog_fat_resp_inc
-    icu.data.icu_cog_resp_inc = (icu.data.icu_cog_resp_inc - icu.data.icu_cog_fat_resp_inc)
-    
-    # fat_resp_inc = fat_resp_inc - cog_fat_resp_inc
-    icu.data.icu_fat_resp_inc = (icu.data.icu_fat_resp_inc - icu.data.icu_cog_fat_resp_inc)
-    
+# roots['defaults'] keys each severity depends on, used to reuse results
+# across scenarios that only differ in other parameters
+SEVERITY_DEFAULTS = {
+    'midmod' : ['symp_to_hsp_admit_duration', 'incubation_period', 
+                'midmod_duration_no_hsp'],
+    'hospital' : ['icu_to_death_duration', 'hsp_no_icu_death_duration', 
+                  'hsp_no_icu_no_death_duration', 'hsp_midmod_after_discharge_duration'],
+    'icu' : ['icu_to_death_duration', 'icu_no_death_duration', 
+             'icu_midmod_after_discharge_duration']
+    }
 
-    # critical long-term prevalence = critical long-term incidence * [duration]
-    icu.data = calc_prev(df=icu.data, dp=dp, dst_population='icu', 
-                         dst_outcome='cognitive', calc_col_stub='icu_cog_')
-    icu.data = calc_prev(df=icu.data, dp=dp, dst_population='icu', 
-                         dst_outcome='fatigue', calc_col_stub='icu_fat_')
-    icu.data = calc_prev(df=icu.data, dp=dp, dst_population='icu', 
-                         dst_outcome='respiratory', calc_col_stub='icu_resp_')
-    icu.data = calc_prev(df=icu.data, dp=dp, dst_population='icu', 
-                         dst_outcome='cognitive_fatigue', calc_col_stub='icu_cog_fat_')
-    icu.data = calc_prev(df=icu.data, dp=dp, dst_population='icu', 
-                         dst_outcome='cognitive_respiratory', calc_col_stub='icu_cog_resp_')
-    icu.data = calc_prev(df=icu.data, dp=dp, dst_population='icu', 
-                         dst_outcome='fatigue_respiratory', calc_col_stub='icu_fat_resp_')
-    icu.data = calc_prev(df=icu.data, dp=dp, dst_population='icu', 
-                         dst_outcome='cognitive_fatigue_respiratory', 
-                         calc_col_stub='icu_cog_fat_resp_')
+# Shifted copies each severity takes: (input, calc_cols, roots['defaults'] key of the lag)
+SEVERITY_SHIFTS = {
+    'midmod' : [('hsp_admit', ['hospital_inc'], 'symp_to_hsp_admit_duration')],
+    'hospital' : [('icu_admit', ['icu_inc'], 'icu_to_death_duration'), 
+                  ('hsp_admit', ['hospital_deaths'], 'hsp_no_icu_death_duration')],
+    'icu' : [('icu_admit', ['icu_deaths'], 'icu_to_death_duration')]
+    }
 
 
-    # Remove unneeded cols
-    icu.data = icu.data.drop(columns=['icu_inc', 'icu_deaths', 'icu_risk_num'])
-    del dp
+def get_severity_key(severity, sc):
+    ''' Parameters a severity's results depend on in a scenario '''
+    return((sc['dp_path'], tuple(sc['defaults'][k] for k in SEVERITY_DEFAULTS[severity])))
 
-    # endregion ----------------------------------------------------------------
 
+def plan_shifts(scenarios):
+    ''' Number of times each shifted copy of each input is used over the 
+        scenarios, skipping severities reused from the previous scenario
+    Arguments:
+        scenarios : list
+            As returned by get_scenarios
+    '''
+    uses = {'hsp_admit' : {}, 'icu_admit' : {}}
+    last = {}
+    for sc in scenarios:
+        for severity, lags in SEVERITY_SHIFTS.items():
+            key = get_severity_key(severity, sc)
+            if last.get(severity) == key:
+                continue
+            last[severity] = key
+            for dst_type, calc_cols, param in lags:
+                shift = (tuple(calc_cols), sc['defaults'][param])
+                uses[dst_type][shift] = uses[dst_type].get(shift, 0) + 1
+    return(uses)
+
+
+def aggregate_severities(midmod, hospital, icu):
+    ''' Sum long-term incidence and prevalence across severities
+    Arguments:
+        midmod : Pandas DataFrame
+        hospital : Pandas DataFrame
+        icu : Pandas DataFrame
+    '''
+    df = pd.merge(midmod, hospital, how='outer', on=KEYS)
+    df = pd.merge(df, icu, how='outer', on=KEYS)
+
+    for outcome, short in OUTCOMES.items():
+        for measure in ['inc', 'prev']:
+            cols = ['{}_{}_{}'.format(sev, short, measure) for sev in ['midmod', 'hospital', 'icu']]
+            df['{}_{}'.format(outcome, measure)] = df[cols].sum(axis=1)
+            df.drop(columns=cols, inplace=True)
 
-    print('Aggregating severities...')
-    ## Aggregate Severities
+    return(df)
+
+
+# Aggregate age groups and sex
+ALL_AGES = 22
+AGE_STANDARDIZED = 27
+BOTH_SEXES = 3
+
+
+def calc_age_sex_aggregates(df, age_weights):
+    ''' Both-sex, all-age and age-standardized results from most-detailed 
+        results. Counts and population are summed, so aggregate rates are 
+        population weighted. Age-standardized rates weight each age-specific 
+        rate by the standard age weights and have no counts.
+    Arguments:
+        df : Pandas DataFrame
+            Most-detailed counts with population
+        age_weights : Pandas DataFrame
+            age_group_id and age_group_weight_value
+    Returns:
+        (both sexes by most-detailed age, all-age and age-standardized by sex)
+    '''
+    group_cols = ['location_id', 'year_id', 'draw_var']
+    count_cols = ['{}_{}'.format(outcome, measure) for outcome in OUTCOMES 
+                  for measure in ['inc', 'prev']]
+
+    # Both sexes, by age
+    both = df.groupby(group_cols + ['age_group_id'], as_index=False)[count_cols + ['population']].sum()
+    both['sex_id'] = BOTH_SEXES
+    by_age = pd.concat([df[group_cols + ['age_group_id', 'sex_id', 'population'] + count_cols], both])
+
+    # All ages, by sex (including both sexes)
+    all_ages = by_age.groupby(group_cols + ['sex_id'], as_index=False)[count_cols + ['population']].sum()
+    all_ages['age_group_id'] = ALL_AGES
+
+    for agg in [by_age, all_ages]:
+        for col in count_cols:
+            agg['{}_rate'.format(col)] = agg[col] / agg.population
+
+    # Age-standardized, by sex (including both sexes)
+    rate_cols = ['{}_rate'.format(col) for col in count_cols]
+    w = age_weights[age_weights.age_group_id.isin(roots['age_groups'])]
+    w = w.set_index('age_group_id').age_group_weight_value
+    weighted = by_age[rate_cols].mul(by_age.age_group_id.map(w / w.sum()), axis=0)
+    weighted[group_cols + ['sex_id']] = by_age[group_cols + ['sex_id']]
+    age_std = weighted.groupby(group_cols + ['sex_id'], as_index=False)[rate_cols].sum()
+    age_std['age_group_id'] = AGE_STANDARDIZED
+    del weighted
+
+    all_ages = pd.concat([all_ages, age_std], ignore_index=True)
+    both = by_age[by_age.sex_id == BOTH_SEXES].reset_index(drop=True)
+    for agg in [both, all_ages]:
+        # Temporary values
+        for outcome in OUTCOMES:
+            agg['{}_YLD'.format(outcome)] = agg['{}_prev_rate'.format(outcome)] * 0.01
+
+    return(both, all_ages)
+
+
+def get_age_sex_outputs(df, both, all_ages):
+    ''' Files written per year for most-detailed and aggregate age / sex
+        results, as (filename suffix, data, expected ages, expected sexes)
+    Arguments:
+        df : Pandas DataFrame
+            Most-detailed results
+        both : Pandas DataFrame
+        all_ages : Pandas DataFrame
+            As returned by calc_age_sex_aggregates
+    '''
+    return([('', df, None, None), 
+            ('_both_sexes', both, None, [BOTH_SEXES]), 
+            ('_all_ages', all_ages, [ALL_AGES, AGE_STANDARDIZED], [1, 2, BOTH_SEXES])])
+
+
+def get_state_dir(output_version, loc_name, loc_id):
+    ''' Directory holding a location's incremental update state '''
+    return('{}{}/stage_2/{}_{}/incremental/'.format(get_core_ref('data_output', 'stage_2'), 
+                                                   output_version, loc_name, loc_id))
+
+
+def get_state_settings(scenario, param_draws, seed, years):
+    ''' Settings an incremental update must share with the run it updates
+    Arguments:
+        scenario : dict
+            As returned by get_scenarios
+        param_draws : str (optional)
+        seed : int
+        years : list
+    '''
+    if param_draws is not None and not isinstance(param_draws, str):
+        raise ValueError('Incremental updates need param_draws as None, \'sample\' or a path')
+    # Round trip through json so settings compare equal to stored ones
+    return(json.loads(json.dumps({'defaults' : scenario['defaults'], 
+                                  'dp_path' : scenario['dp_path'], 
+                                  'param_draws' : param_draws, 'seed' : seed, 
+                                  'years' : sorted(years)})))
+
+
+def read_state(output_version, loc_name, loc_id, settings):
+    ''' Read the state saved by a previous run, or None if there is none or
+        it was run with different settings
+    Arguments:
+        output_version : str
+            Version the state was saved under
+        loc_name : str
+        loc_id : int
+        settings : dict
+            As returned by get_state_settings
+    '''
+    state_dir = get_state_dir(output_version, loc_name, loc_id)
+    if not os.path.exists('{}state.json'.format(state_dir)):
+        print('  no saved state for {}, running in full...'.format(output_version))
+        return(None)
+
+    with open('{}state.json'.format(state_dir)) as f:
+        state = json.load(f)
+    if state['settings'] != settings:
+        print('  saved state for {} has different settings, running in full...'.format(output_version))
+        return(None)
+
+    state['last_date'] = pd.Timestamp(state['last_date'])
+    state['kept_from'] = pd.Timestamp(state['kept_from'])
+    state['annual'] = pd.read_pickle('{}annual.pkl'.format(state_dir))
+    state['daily'] = pd.read_pickle('{}daily.pkl'.format(state_dir))
+    return(state)
+
+
+def write_state(output_version, loc_name, loc_id, settings, last_date, kept_from, 
+                annual, daily):
+    ''' Save the annual sums, and the daily results an update may replace
+    Arguments:
+        output_version : str
+        loc_name : str
+        loc_id : int
+        settings : dict
+        last_date : datetime
+            Last input date used
+        kept_from : datetime
+            First date of daily
+        annual : Pandas DataFrame
+            Summed incidence and prevalence by year, before dividing by days
+        daily : Pandas DataFrame
+            Daily incidence and prevalence from kept_from
+    '''
+    state_dir = get_state_dir(output_version, loc_name, loc_id)
+    os.makedirs(state_dir, exist_ok=True)
+    annual.to_pickle('{}annual.pkl'.format(state_dir))
+    daily.to_pickle('{}daily.pkl'.format(state_dir))
+    # Written last, so a partial state is never read
+    with open('{}state.json'.format(state_dir), 'w') as f:
+        json.dump({'settings' : settings, 
+                   'last_date' : '{:%Y-%m-%d}'.format(last_date), 
+                   'kept_from' : '{:%Y-%m-%d}'.format(kept_from)}, f, indent=2)
+
+
+def update_annual(state, annual, recompute_from, calc_cols):
+    ''' Previous annual sums with the contributions of dates from 
+        recompute_from replaced by their recomputed values
+    Arguments:
+        state : dict
+            As returned by read_state
+        annual : Pandas DataFrame
+            Annual sums over the recomputed dates
+        recompute_from : datetime
+        calc_cols : list
+    '''
+    group_cols = ['location_id', 'age_group_id', 'sex_id', 'draw_var', 'year_id']
+    old = state['daily'][state['daily'].date >= recompute_from]
+    old = old.groupby(group_cols)[calc_cols].sum()
+
+    total = (state['annual'].set_index(group_cols)[calc_cols]
+             .sub(old, fill_value=0)
+             .add(annual.set_index(group_cols)[calc_cols], fill_value=0))
+    return(total.reset_index())
+
+
+def main(loc_id, loc_name, output_version, param_draws=None, seed=0, prefetch=True, 
+         compression=None, years=None, scenarios=None, parallel=False, 
+         record_resources=True, sparse=False, previous_version=None, save_state=False, 
+         revise_days=0):
+    if years is None:
+        years = [2020]
+    scenarios = get_scenarios(scenarios)
+    check_compression(compression)
+    timer = StageTimer()
+
+    # Incremental updates build on a previous run of the same single scenario
+    if previous_version is not None:
+        save_state = True
+    if save_state:
+        if scenarios[0]['scenario'] is not None:
+            raise ValueError('Incremental updates do not support scenarios')
+        settings = get_state_settings(scenarios[0], param_draws, seed, years)
+
+    print('Reading in short-term outcomes...')
+    ## Read in short-term outcomes
     # region -------------------------------------------------------------------
     
-    df = copy.deepcopy(midmod)
-    del midmod
-    df.data = pd.merge(df.data, hospital.data, how='outer',
-                       on=['location_id', 'age_group_id', 'sex_id', 'draw_var', 
-                           'date'])
-    del hospital
-    df.data = pd.merge(df.data, icu.data, how='outer',
-                       on=['location_id', 'age_group_id', 'sex_id', 'draw_var', 
-                           'date'])
-    del icu
-
-
-    # Incidence
-    df.data['cognitive_inc'] = df.data[['midmod_cog_inc', 'hospital_cog_inc', 
-                                        'icu_cog_inc']].sum(axis=1)
-    df.data.drop(columns=['midmod_cog_inc', 'hospital_cog_inc', 'icu_cog_inc'], 
-                 inplace=True)
-    df.data['fatigue_inc'] = df.data[['midmod_fat_inc', 'hospital_fat_inc', 
-                                      'icu_fat_inc']].sum(axis=1)
-    df.data.drop(columns=['midmod_fat_inc', 'hospital_fat_inc', 'icu_fat_inc'], 
-                 inplace=True)
-    df.data['respiratory_inc'] = df.data[['midmod_resp_inc', 'hospital_resp_inc', 
-                                          'icu_resp_inc']].sum(axis=1)
-    df.data.drop(columns=['midmod_resp_inc', 'hospital_resp_inc', 'icu_resp_inc'], 
-                 inplace=True)
-    df.data['cognitive_fatigue_inc'] = df.data[['midmod_cog_fat_inc', 'hospital_cog_fat_inc', 
-                                                'icu_cog_fat_inc']].sum(axis=1)
-    df.data.drop(columns=['midmod_cog_fat_inc', 'hospital_cog_fat_inc', 'icu_cog_fat_inc'], 
-                 inplace=True)
-    df.data['cognitive_respiratory_inc'] = df.data[['midmod_cog_resp_inc',
-                                                    'hospital_cog_resp_inc',
-                                                    'icu_cog_resp_inc']].sum(axis=1)
-    df.data.drop(columns=['midmod_cog_resp_inc', 'hospital_cog_resp_inc', 'icu_cog_resp_inc'], 
-                 inplace=True)
-    df.data['fatigue_respiratory_inc'] = df.data[['midmod_fat_resp_inc', 
-                                                  'hospital_fat_resp_inc', 
-                                                  'icu_fat_resp_inc']].sum(axis=1)
-    df.data.drop(columns=['midmod_fat_resp_inc', 'hospital_fat_resp_inc', 'icu_fat_resp_inc'], 
-                 inplace=True)
-    df.data['cognitive_fatigue_respiratory_inc'] = df.data[['midmod_cog_fat_resp_inc', 
-                                                            'hospital_cog_fat_resp_inc', 
-                                                            'icu_cog_fat_resp_inc'
-                                                            ]].sum(axis=1)
-    df.data.drop(columns=['midmod_cog_fat_resp_inc', 'hospital_cog_fat_resp_inc', 
-                          'icu_cog_fat_resp_inc'], inplace=True)
-
+    # Inputs load concurrently; computation starts once the datasets it
+    # needs are ready (icu is not needed until severe is calculated)
+    pool = ThreadPoolExecutor(max_workers=4 if prefetch else 1)
+    try:
+        # Only dates that can shift into the analysis years (under any scenario) are loaded
+        windows = [get_input_window(datetime.datetime(min(years), 1, 1), 
+                                    datetime.datetime(max(years), 12, 31), 
+                                    defaults=sc['defaults']) for sc in scenarios]
+        date_window = (min(w[0] for w in windows), max(w[1] for w in windows))
+        pad = datetime.datetime(min(years), 1, 1) - windows[0][0]
+
+        # Input dates each year's outputs come from (under any scenario), 
+        # checked when the inputs are validated
+        year_windows = {}
+        for year in years:
+            w = [get_year_window(year, defaults=sc['defaults']) for sc in scenarios]
+            year_windows[year] = (min(x[0] for x in w), max(x[1] for x in w))
+
+        # Incremental update: input dates after the previous run's last date (less
+        # revise_days, for revised inputs) change output dates from one longest
+        # lag chain earlier, and those need inputs from one lag chain before that
+        state = None
+        if previous_version is not None:
+            state = read_state(previous_version, loc_name, loc_id, settings)
+        if state is not None:
+            recompute_from = state['last_date'] + pd.to_timedelta(1 - revise_days, unit='D') - pad
+            if recompute_from < state['kept_from']:
+                print('  saved state for {} starts after {:%Y-%m-%d}, running in full...'.format(
+                    previous_version, recompute_from))
+                state = None
+            else:
+                print('  updating from {:%Y-%m-%d}...'.format(recompute_from))
+                date_window = (recompute_from - pad, date_window[1])
+
+        # Durations and proportions
+        dp_paths = set(sc['dp_path'] for sc in scenarios)
+        dp = {path : pool.submit(read_table, path if path is not None else 
+                                 '{}WORK/12_bundle/covid/data/long_covid/long_covid_proportions_durations_with_overlaps.csv'.format(roots['j']))
+              for path in dp_paths}
     
-    # Prevalence
-    df.data['cognitive_prev'] = df.data[['midmod_cog_prev', 'hospital_cog_prev', 
-                                         'icu_cog_prev']].sum(axis=1)
-    df.data.drop(columns=['midmod_cog_prev', 'hospital_cog_prev', 'icu_cog_prev'], 
-                 inplace=True)
-    df.data['fatigue_prev'] = df.data[['midmod_fat_prev', 'hospital_fat_prev', 
-                                       'icu_fat_prev']].sum(axis=1)
-    df.data.drop(columns=['midmod_fat_prev', 'hospital_fat_prev', 'icu_fat_prev'], 
-                 inplace=True)
-    df.data['respiratory_prev'] = df.data[['midmod_resp_prev', 'hospital_resp_prev', 
-                                           'icu_resp_prev']].sum(axis=1)
-    df.data.drop(columns=['midmod_resp_prev', 'hospital_resp_prev', 'icu_resp_prev'], 
-                 inplace=True)
-    df.data['cognitive_fatigue_prev'] = df.data[['midmod_cog_fat_prev', 'hospital_cog_fat_prev', 
-                                                 'icu_cog_fat_prev']].sum(axis=1)
-    df.data.drop(columns=['midmod_cog_fat_prev', 'hospital_cog_fat_prev', 'icu_cog_fat_prev'], 
-                 inplace=True)
-    df.data['cognitive_respiratory_prev'] = df.data[['midmod_cog_resp_prev',
-                                                     'hospital_cog_resp_prev',
-                                                     'icu_cog_resp_prev']].sum(axis=1)
-    df.data.drop(columns=['midmod_cog_resp_prev', 'hospital_cog_resp_prev', 'icu_cog_resp_prev'], 
-                 inplace=True)
-    df.data['fatigue_respiratory_prev'] = df.data[['midmod_fat_resp_prev', 
-                                                   'hospital_fat_resp_prev', 
-                                                   'icu_fat_resp_prev']].sum(axis=1)
-    df.data.drop(columns=['midmod_fat_resp_prev', 'hospital_fat_resp_prev', 'icu_fat_resp_prev'], 
-                 inplace=True)
-    df.data['cognitive_fatigue_respiratory_prev'] = df.data[['midmod_cog_fat_resp_prev', 
-                                                             'hospital_cog_fat_resp_prev', 
-                                                             'icu_cog_fat_resp_prev'
-                                                             ]].sum(axis=1)
-    df.data.drop(columns=['midmod_cog_fat_resp_prev', 'hospital_cog_fat_resp_prev', 
-                           'icu_cog_fat_resp_prev'], inplace=True)
+        # Shifted copies of hospital and icu are kept until their last use
+        shift_uses = plan_shifts(scenarios)
 
+        # Mild/Moderate
+        midmod = Dataset.submit(pool, loc_id, loc_name, output_version, 'midmod', nf_type='long', 
+                                date_window=date_window, sparse=sparse, year_windows=year_windows)
+    
+        # Hospital
+        hospital = Dataset.submit(pool, loc_id, loc_name, output_version, 'hsp_admit', nf_type='long', 
+                                  date_window=date_window, sparse=sparse, year_windows=year_windows, 
+                                  shift_uses=shift_uses['hsp_admit'])
+
+        # Icu
+        icu_future = Dataset.submit(pool, loc_id, loc_name, output_version, 'icu_admit', nf_type='long', 
+                                    date_window=date_window, sparse=sparse, year_windows=year_windows, 
+                                    shift_uses=shift_uses['icu_admit'])
+        pool.shutdown(wait=False)
+
+        print('  mild/moderate...')
+
+        midmod = midmod.result()
+
+        # Every year needs input dates that shift into it
+        missing = [y for y, (start, end) in year_windows.items() 
+                   if midmod.dates[1] < start or midmod.dates[0] > end]
+        if missing:
+            raise ValueError('No input dates for years {}: inputs cover {:%Y-%m-%d} to {:%Y-%m-%d}'.format(
+                ', '.join(map(str, missing)), *midmod.dates))
+        print('  hospital...')
+        hospital = hospital.result()
+
+
+        # Proportion / duration parameters, per-draw vectors if param_draws given
+        draws = sorted(midmod.draws, key=lambda d: int(d.split('_')[-1]))
+        params = {path : get_params(f.result(), draws=draws, param_draws=param_draws, seed=seed)
+                  for path, f in dp.items()}
+        del dp
+        if param_draws is None:
+            draws = None
+
+
+        # Pull population
+        pop = get_population(age_group_id = roots['age_groups'],
+                             single_year_age = False, location_id = loc_id, 
+                             location_set_id = 35, year_id = years, 
+                             sex_id = [1,2], gbd_round_id = roots['gbd_round'], 
+                             status = 'best', decomp_step = roots['decomp_step'])
+        pop.drop(columns=['run_id'], inplace=True)
+        age_weights = get_age_weights(gbd_round_id = roots['gbd_round'])
+
+
+        # Read in disability weights
+        dw = read_table('{}dws.csv'.format(roots['disability_weight']))
+    except BaseException:
+        # Stop the other loads before raising, so a failed run does not leave
+        # inputs loading in the background (e.g. into the next worker job)
+        pool.shutdown(wait=True, cancel_futures=True)
+        raise
+
+    timer.stop('load')
     # endregion ----------------------------------------------------------------
 
 
-    print('Aggregating by year...')
-    ## Aggregate by year
-    # region -------------------------------------------------------------------
+    # Lagged copies and severity results are reused between scenarios
+    sweep = len(scenarios) > 1
+    last = {}
+    def reuse(severity, sc, fn, *args):
+        key = get_severity_key(severity, sc)
+        if severity not in last or last[severity][0] != key:
+            last[severity] = (key, fn(*args, params=params[sc['dp_path']], 
+                                      defaults=sc['defaults'], draws=draws, cache=sweep))
+        return(last[severity][1])
+
+    for sc in scenarios:
+        if sc['scenario'] is not None:
+            print('Scenario {}...'.format(sc['scenario']))
+
+        print('Calculating mild/moderate, severe and critical incidence & prevalence...')
+        ## Mild/Moderate, Severe & Critical Incidence & Prevalence
+        # region ---------------------------------------------------------------
 
-    # Subset to 2020
-    df.data = df.data[(df.data.date >= datetime.datetime(2020, 1, 1)) &
-                       (df.data.date <= datetime.datetime(2020, 12, 31))]
+        # The severities only share read-only lagged copies of hospital and icu
+        # until aggregation, so in parallel mode they run on separate threads
+        # (the pandas / NumPy kernels doing the work release the GIL). Tasks
+        # needing icu wait on it themselves, so mild/moderate can start while
+        # icu is still loading. Otherwise they run one at a time, in order.
+        with ThreadPoolExecutor(max_workers=3 if parallel else 1) as sev_pool:
+            midmod_df = sev_pool.submit(reuse, 'midmod', sc, calc_midmod, 
+                                        midmod, hospital)
+            hospital_df = sev_pool.submit(lambda sc: reuse('hospital', sc, calc_hospital, 
+                                                           hospital, icu_future.result()), sc)
+            icu_df = sev_pool.submit(lambda sc: reuse('icu', sc, calc_icu, 
+                                                      icu_future.result()), sc)
+        midmod_df, hospital_df, icu_df = midmod_df.result(), hospital_df.result(), icu_df.result()
 
+        timer.stop('severities')
+        # endregion ------------------------------------------------------------
 
-    # Sum by day
-    df.collapse(agg_function='sum',
-                group_cols=['location_id', 'age_group_id', 'sex_id', 'draw_var'],
-                calc_cols=['cognitive_inc', 'cognitive_prev', 'fatigue_inc', 'fatigue_prev',
-                           'respiratory_inc', 'respiratory_prev', 'cognitive_fatigue_inc', 
-                           'cognitive_fatigue_prev','cognitive_respiratory_inc', 
-                           'cognitive_respiratory_prev', 'fatigue_respiratory_inc', 
-                           'fatigue_respiratory_prev','cognitive_fatigue_respiratory_inc', 
-                           'cognitive_fatigue_respiratory_prev'])
 
+        print('Aggregating severities...')
+        ## Aggregate Severities
+        # region ---------------------------------------------------------------
+        df = Dataset(loc_id, loc_name, output_version, 'long_covid', nf_type='long', 
+                     data=aggregate_severities(midmod_df, hospital_df, icu_df), 
+                     sparse=sparse)
+        del midmod_df, hospital_df, icu_df
+        # endregion ------------------------------------------------------------
 
-    # Divide prevalence by 366
-    df.data.cognitive_prev = df.data.cognitive_prev / 366
-    df.data.fatigue_prev = df.data.fatigue_prev / 366
-    df.data.respiratory_prev = df.data.respiratory_prev / 366
-    df.data.cognitive_fatigue_prev = df.data.cognitive_fatigue_prev / 366
-    df.data.cognitive_respiratory_prev = df.data.cognitive_respiratory_prev / 366
-    df.data.fatigue_respiratory_prev = df.data.fatigue_respiratory_prev / 366
-    df.data.cognitive_fatigue_respiratory_prev = df.data.cognitive_fatigue_respiratory_prev / 366
 
+        print('Aggregating by year...')
+        ## Aggregate by year
+        # region ---------------------------------------------------------------
+        calc_cols = ['{}_{}'.format(outcome, measure) for outcome in OUTCOMES 
+                     for measure in ['inc', 'prev']]
+
+        # Subset to analysis years
+        df.data['year_id'] = df.data.date.dt.year
+        df.data = df.data[df.data.year_id.isin(years)]
+        if state is not None:
+            df.data = df.data[df.data.date >= recompute_from]
+
+
+        # Keep the daily results a later update may replace
+        if save_state:
+            last_date = min(ds.dates[1] for ds in [midmod, hospital, icu_future.result()])
+            kept_from = last_date + pd.to_timedelta(1 - revise_days, unit='D') - pad
+            daily = df.data[df.data.date >= kept_from][KEYS + ['year_id'] + calc_cols]
+            if state is not None and kept_from < recompute_from:
+                kept_from = max(kept_from, state['kept_from'])
+                daily = pd.concat([state['daily'][(state['daily'].date >= kept_from) & 
+                                                  (state['daily'].date < recompute_from)], 
+                                   daily], ignore_index=True)
+
+
+        # Sum by day
+        df.collapse(agg_function='sum',
+                    group_cols=['location_id', 'age_group_id', 'sex_id', 'draw_var', 'year_id'],
+                    calc_cols=calc_cols)
+
+        # Replace the recomputed dates in the previous annual sums
+        if state is not None:
+            df.data = update_annual(state, df.data, recompute_from, calc_cols)
+            del state
+        if save_state:
+            annual = df.data.copy()
+
+        # Add back the all-zero rows left out of sparse data
+        if df.sparse:
+            df.complete({'location_id' : [loc_id], 'age_group_id' : roots['age_groups'], 
+                         'sex_id' : [1, 2], 'draw_var' : midmod.draws, 'year_id' : years})
+
+
+        # Divide prevalence by number of days in each year
+        n_days = df.data.year_id.map({y : 366 if calendar.isleap(y) else 365 for y in years})
+        for outcome in OUTCOMES:
+            df.data['{}_prev'.format(outcome)] = df.data['{}_prev'.format(outcome)] / n_days
+
+
+        # Ensure incidence and prevalence aren't negative
+        df.check_neg(calc_cols=calc_cols)
+
+        # endregion ------------------------------------------------------------
+
+
+        print('Calculating rates...')
+        ## Calculate rates
+        # region ---------------------------------------------------------------
+
+        # Merge population
+        df.data = pd.merge(df.data, pop, how='left',
+                           on=['location_id', 'age_group_id', 'sex_id', 'year_id'])
 
-    # Ensure incidence and prevalence aren't negative
-    df.check_neg(calc_cols=['cognitive_inc', 'cognitive_prev', 'fatigue_inc', 'fatigue_prev',
-                            'respiratory_inc', 'respiratory_prev', 'cognitive_fatigue_inc', 
-                            'cognitive_fatigue_prev','cognitive_respiratory_inc', 
-                            'cognitive_respiratory_prev', 'fatigue_respiratory_inc', 
-                            'fatigue_respiratory_prev','cognitive_fatigue_respiratory_inc', 
-                            'cognitive_fatigue_respiratory_prev'])
 
-    # endregion ----------------------------------------------------------------
+        # Calculate rates
+        for col in calc_cols:
+            df.data['{}_rate'.format(col)] = df.data[col] / df.data.population
+
+        # endregion ------------------------------------------------------------
 
 
-    print('Calculating rates...')
-    ## Calculate rates
-    # region -------------------------------------------------------------------
+        print('Calculating YLDs...')
+        ## Calculate YLDs
+        # region ---------------------------------------------------------------
 
-    # Pull population
-    pop = get_population(age_group_id = roots['age_groups'],
-                         single_year_age = False, location_id = loc_id, 
-                         location_set_id = 35, year_id = roots['gbd_year'], 
-                         sex_id = [1,2], gbd_round_id = roots['gbd_round'], 
-                         status = 'best', decomp_step = roots['decomp_step'])
-    pop.drop(columns=['year_id', 'run_id'], inplace=True)
+        # Temporary values
+        for outcome in OUTCOMES:
+            df.data['{}_YLD'.format(outcome)] = df.data['{}_prev_rate'.format(outcome)] * 0.01
 
-    
-    # Merge population
-    df.data = pd.merge(df.data, pop, how='left',
-                       on=['location_id', 'age_group_id', 'sex_id'])
-
-
-    # Calculate rates
-    df.data['cognitive_inc_rate'] = df.data.cognitive_inc / df.data.population
-    df.data['fatigue_inc_rate'] = df.data.fatigue_inc / df.data.population
-    df.data['respiratory_inc_rate'] = df.data.respiratory_inc / df.data.population
-    df.data['cognitive_fatigue_inc_rate'] = df.data.cognitive_fatigue_inc / df.data.population
-    df.data['cognitive_respiratory_inc_rate'] = df.data.cognitive_respiratory_inc / df.data.population
-    df.data['fatigue_respiratory_inc_rate'] = df.data.fatigue_respiratory_inc / df.data.population
-    df.data['cognitive_fatigue_respiratory_inc_rate'] = df.data.cognitive_fatigue_respiratory_inc / df.data.population
-
-    df.data['cognitive_prev_rate'] = df.data.cognitive_prev / df.data.population
-    df.data['fatigue_prev_rate'] = df.data.fatigue_prev / df.data.population
-    df.data['respiratory_prev_rate'] = df.data.respiratory_prev / df.data.population
-    df.data['cognitive_fatigue_prev_rate'] = df.data.cognitive_fatigue_prev / df.data.population
-    df.data['cognitive_respiratory_prev_rate'] = df.data.cognitive_respiratory_prev / df.data.population
-    df.data['fatigue_respiratory_prev_rate'] = df.data.fatigue_respiratory_prev / df.data.population
-    df.data['cognitive_fatigue_respiratory_prev_rate'] = df.data.cognitive_fatigue_respiratory_prev / df.data.population
-    # endregion ----------------------------------------------------------------
 
+        # Both-sex, all-age and age-standardized aggregates
+        both_sexes, all_ages = calc_age_sex_aggregates(df.data, age_weights)
 
-    print('Calculating YLDs...')
-    ## Calculate YLDs
-    # region -------------------------------------------------------------------
+        timer.stop('aggregate')
+        # endregion ------------------------------------------------------------
 
-    # Read in disability weights
-    dw = pd.read_csv('{}dws.csv'.format(roots['disability_weight']))
 
-    # Temporary values
-    df.data['cognitive_YLD'] = df.data.cognitive_prev_rate * 0.01
-    df.data['fatigue_YLD'] = df.data.fatigue_prev_rate * 0.01
-    df.data['respiratory_YLD'] = df.data.respiratory_prev_rate * 0.01
-    df.data['cognitive_fatigue_YLD'] = df.data.cognitive_fatigue_prev_rate * 0.01
-    df.data['cognitive_respiratory_YLD'] = df.data.cognitive_respiratory_prev_rate * 0.01
-    df.data['fatigue_respiratory_YLD'] = df.data.fatigue_respiratory_prev_rate * 0.01
-    df.data['cognitive_fatigue_respiratory_YLD'] = df.data.cognitive_fatigue_respiratory_prev_rate * 0.01
+        print('Saving datasets and running diagnostics...')
+        ## Save datasets & run diagnostics
+        # region ---------------------------------------------------------------
 
-    del dw
+        # One set of outputs per year, tagged by scenario in a sweep. Aggregates
+        # are written next to the most-detailed files.
+        tag = '' if sc['scenario'] is None else '_{}'.format(sc['scenario'])
+        outputs = get_age_sex_outputs(df.data, both_sexes, all_ages)
+        for year in years:
+            for suffix, data, ages, sexes in outputs:
+                out = Dataset(loc_id, loc_name, output_version, 'long_covid', nf_type='long', 
+                              data=data[data.year_id == year])
+                for outcome in OUTCOMES:
+                    out.save_data(output_cols=['location_id', 'year_id', 'age_group_id', 'sex_id', 'draw_var', 
+                                               '{}_inc'.format(outcome), '{}_prev'.format(outcome), 
+                                               '{}_inc_rate'.format(outcome), '{}_prev_rate'.format(outcome), 
+                                               '{}_YLD'.format(outcome)],
+                                  filename='{}_{}{}{}'.format(outcome, year, suffix, tag), stage='stage_2', 
+                                  compression=compression, ages=ages, sexes=sexes, 
+                                  draws=midmod.draws)
+                del out
+        del df, both_sexes, all_ages
 
-    # endregion ----------------------------------------------------------------
+        timer.stop('save')
+        # endregion ------------------------------------------------------------
 
+    del dw
 
-    print('Saving datasets and running diagnostics...')
-    ## Save datasets & run diagnostics
-    # region -------------------------------------------------------------------
 
-    # Cognitive
-    df.save_data(output_cols=['location_id', 'age_group_id', 'sex_id', 'draw_var',
-                              'cognitive_inc', 'cognitive_prev', 'cognitive_inc_rate',
-                              'cognitive_prev_rate', 'cognitive_YLD'],
-                 filename='cognitive', stage='stage_2')
-
-    # Fatigue
-    df.save_data(output_cols=['location_id', 'age_group_id', 'sex_id', 'draw_var',
-                              'fatigue_inc', 'fatigue_prev', 'fatigue_inc_rate',
-                              'fatigue_prev_rate', 'fatigue_YLD'],
-                 filename='fatigue', stage='stage_2')
-
-    # Respiratory
-    df.save_data(output_cols=['location_id', 'age_group_id', 'sex_id', 'draw_var',
-                              'respiratory_inc', 'respiratory_prev', 'respiratory_inc_rate',
-                              'respiratory_prev_rate', 'respiratory_YLD'],
-                 filename='respiratory', stage='stage_2')
-
-    # Cognitive Fatigue
-    df.save_data(output_cols=['location_id', 'age_group_id', 'sex_id', 'draw_var',
-                              'cognitive_fatigue_inc', 'cognitive_fatigue_prev', 
-                              'cognitive_fatigue_inc_rate', 'cognitive_fatigue_prev_rate', 
-                              'cognitive_fatigue_YLD'],
-                 filename='cognitive_fatigue', stage='stage_2')
-
-    # Cognitive Respiratory
-    df.save_data(output_cols=['location_id', 'age_group_id', 'sex_id', 'draw_var',
-                              'cognitive_respiratory_inc', 'cognitive_respiratory_prev', 'cognitive_respiratory_inc_rate',
-                              'cognitive_respiratory_prev_rate', 'cognitive_respiratory_YLD'],
-                 filename='cognitive_respiratory', stage='stage_2')
-
-    # Fatigue Respiratory
-    df.save_data(output_cols=['location_id', 'age_group_id', 'sex_id', 'draw_var',
-                              'fatigue_respiratory_inc', 'fatigue_respiratory_prev', 
-                              'fatigue_respiratory_inc_rate', 'fatigue_respiratory_prev_rate', 
-                              'fatigue_respiratory_YLD'],
-                 filename='fatigue_respiratory', stage='stage_2')
-
-    # Cognitive Fatigue Respiratory
-    df.save_data(output_cols=['location_id', 'age_group_id', 'sex_id', 'draw_var',
-                              'cognitive_fatigue_respiratory_inc', 
-                              'cognitive_fatigue_respiratory_prev', 
-                              'cognitive_fatigue_respiratory_inc_rate',
-                              'cognitive_fatigue_respiratory_prev_rate', 
-                              'cognitive_fatigue_respiratory_YLD'],
-                 filename='cognitive_fatigue_respiratory', stage='stage_2')
+    # Save state for the next incremental update
+    if save_state:
+        write_state(output_version, loc_name, loc_id, settings, last_date, kept_from, 
+                    annual, daily)
+        del annual, daily
 
-    # endregion ----------------------------------------------------------------
+
+    # Record stage runtimes and memory to calibrate future resource requests
+    # (sweeps are skipped as their stages repeat per scenario, and incremental
+    # updates as their runtime does not scale with input size)
+    if record_resources and not sweep and previous_version is None:
+        record_run(loc_id, output_version, 
+                   midmod.input_cells + hospital.input_cells + icu_future.result().input_cells, 
+                   timer, options=get_run_options(years, sparse, parallel, param_draws, 
+                                                  compression))
 
 
 if __name__ == '__main__':
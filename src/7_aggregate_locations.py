@@ -0,0 +1,195 @@
+'''
+    Script: 7_aggregate_locations.py
+    Author: Kyle Simpson
+
+    Description:
+        Rolls the most-detailed stage_2 long COVID outputs written by
+        6_long_covid.py up a location hierarchy (regions, super-regions,
+        global). Counts and populations are summed across child locations 
+        and rates are recomputed from the aggregate population. Both-sex,
+        all-age and age-standardized files are written alongside, as in
+        6_long_covid.py.
+
+    Notes:
+        Locations are aggregated one at a time from the deepest level up, so
+        each aggregate only ever sums its direct children (which may
+        themselves be aggregates written earlier in the run). Child files are
+        read on a small thread pool and added into a running total as they
+        arrive, keeping at most n_workers child files in memory at once
+        instead of loading every location's draws into one process.
+
+        Populations of aggregates are the sums of their children's, pulled
+        for the most-detailed locations only, so custom aggregates outside
+        the GBD location set are supported.
+
+        The hierarchy is supplied as a local csv with (at least) the columns
+        location_id, location_name, parent_id, level and most_detailed.
+'''
+
+from classes.Dataset import Dataset
+from nf_covid.utils.utils import check_compression, get_core_ref, read_input, roots
+from db_queries import get_age_weights, get_population
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+import importlib
+import pandas as pd
+
+long_covid = importlib.import_module('6_long_covid')
+
+
+OUTCOMES = list(long_covid.OUTCOMES)
+ID_COLS = ['age_group_id', 'sex_id', 'draw_var']
+
+
+def read_child(output_version, loc_name, loc_id, filename, outcome):
+    ''' Read the count columns of one location's stage_2 output
+    Arguments:
+        output_version : str
+        loc_name : str
+        loc_id : int
+        filename : str
+        outcome : str
+    '''
+    df = read_input('{}{}/stage_2/{}_{}/{}.csv'.format(get_core_ref('data_output', 'stage_2'),
+                                                       output_version, loc_name,
+                                                       loc_id, filename),
+                    usecols=ID_COLS + ['{}_inc'.format(outcome),
+                                       '{}_prev'.format(outcome)])
+    return(df.set_index(ID_COLS).sort_index())
+
+
+def sum_children(children, output_version, filename, outcome, n_workers):
+    ''' Sum child location outputs, reading up to n_workers files in parallel
+        while only holding n_workers files in memory at a time. Returns the
+        sum and the first child's draws, which every child should share.
+    Arguments:
+        children : Pandas DataFrame
+        output_version : str
+        filename : str
+        outcome : str
+        n_workers : int
+    '''
+    total = None
+    draws = None
+    pending = deque()
+    children = list(zip(children.location_name, children.location_id))
+
+    with ThreadPoolExecutor(max_workers=n_workers) as pool:
+        while children or pending:
+            # Keep a bounded window of reads in flight
+            while children and len(pending) < n_workers:
+                loc_name, loc_id = children.pop(0)
+                pending.append(pool.submit(read_child, output_version, loc_name,
+                                           loc_id, filename, outcome))
+            df = pending.popleft().result()
+            if draws is None:
+                draws = df.index.get_level_values('draw_var').unique().tolist()
+            total = df if total is None else total.add(df, fill_value=0)
+            del df
+
+    return(total, draws)
+
+
+def main(output_version, hierarchy_path, years=None, n_workers=4, compression=None):
+    if years is None:
+        years = [2020]
+    check_compression(compression)
+
+    print('Reading location hierarchy...')
+    ## Read in hierarchy
+    # region -------------------------------------------------------------------
+
+    hierarchy = pd.read_csv(hierarchy_path)
+    aggregates = hierarchy[hierarchy.most_detailed == 0].sort_values('level',
+                                                                     ascending=False)
+
+    # Pull population for all most-detailed locations at once
+    detailed = hierarchy[hierarchy.most_detailed == 1].location_id.tolist()
+    pop = get_population(age_group_id = roots['age_groups'],
+                         single_year_age = False,
+                         location_id = detailed,
+                         location_set_id = 35, year_id = years,
+                         sex_id = [1,2], gbd_round_id = roots['gbd_round'],
+                         status = 'best', decomp_step = roots['decomp_step'])
+    pop.drop(columns=['run_id'], inplace=True)
+    missing = sorted(set(detailed) - set(pop.location_id))
+    if missing:
+        raise ValueError('No population for locations {}'.format(', '.join(map(str, missing))))
+
+    # Aggregate populations are summed from their children, deepest level 
+    # first, so they match the locations summed into each aggregate
+    group_cols = ['year_id', 'age_group_id', 'sex_id']
+    for agg in aggregates.itertuples():
+        children = hierarchy[(hierarchy.parent_id == agg.location_id) &
+                             (hierarchy.location_id != agg.location_id)]
+        agg_pop = (pop[pop.location_id.isin(children.location_id)]
+                   .groupby(group_cols, as_index=False).population.sum())
+        agg_pop['location_id'] = agg.location_id
+        pop = pd.concat([pop, agg_pop], ignore_index=True)
+    age_weights = get_age_weights(gbd_round_id = roots['gbd_round'])
+
+    # endregion ----------------------------------------------------------------
+
+
+    print('Aggregating locations...')
+    ## Aggregate locations, deepest level first
+    # region -------------------------------------------------------------------
+
+    for agg in aggregates.itertuples():
+        print('  {} ({})...'.format(agg.location_name, agg.location_id))
+        children = hierarchy[(hierarchy.parent_id == agg.location_id) &
+                             (hierarchy.location_id != agg.location_id)]
+
+        for year in years:
+            # All outcomes at once, as the age / sex aggregates need them together
+            df = None
+            for outcome in OUTCOMES:
+                total, draws = sum_children(children, output_version, 
+                                            '{}_{}'.format(outcome, year), outcome, 
+                                            n_workers)
+                df = total if df is None else df.join(total)
+                del total
+            df = df.reset_index()
+            df['location_id'] = agg.location_id
+            df['year_id'] = year
+
+            # Recalculate rates from the aggregate population
+            df = pd.merge(df, pop, how='left',
+                          on=['location_id', 'year_id', 'age_group_id', 'sex_id'])
+            if df.population.isnull().any():
+                raise ValueError('Missing population for {} ({}) in {}'.format(
+                    agg.location_name, agg.location_id, year))
+            for outcome in OUTCOMES:
+                df['{}_inc_rate'.format(outcome)] = df['{}_inc'.format(outcome)] / df.population
+                df['{}_prev_rate'.format(outcome)] = df['{}_prev'.format(outcome)] / df.population
+
+                # Temporary values, matching 6_long_covid.py
+                df['{}_YLD'.format(outcome)] = df['{}_prev_rate'.format(outcome)] * 0.01
+
+            # Both-sex, all-age and age-standardized aggregates
+            both_sexes, all_ages = long_covid.calc_age_sex_aggregates(df, age_weights)
+
+            for suffix, data, ages, sexes in long_covid.get_age_sex_outputs(df, both_sexes, 
+                                                                            all_ages):
+                ds = Dataset(agg.location_id, agg.location_name, output_version,
+                             'long_covid', nf_type='long', data=data)
+                for outcome in OUTCOMES:
+                    ds.save_data(output_cols=['location_id', 'year_id', 'age_group_id', 'sex_id', 'draw_var',
+                                              '{}_inc'.format(outcome), '{}_prev'.format(outcome),
+                                              '{}_inc_rate'.format(outcome),
+                                              '{}_prev_rate'.format(outcome),
+                                              '{}_YLD'.format(outcome)],
+                                 filename='{}_{}{}'.format(outcome, year, suffix), 
+                                 stage='stage_2', compression=compression, 
+                                 ages=ages, sexes=sexes, draws=draws)
+                del ds
+            del df, both_sexes, all_ages
+
+    # endregion ----------------------------------------------------------------
+
+
+if __name__ == '__main__':
+    output_version='2021-02-04.01'
+    hierarchy_path='{}location_hierarchy_35.csv'.format(roots['nf_repo'])
+
+    main(output_version, hierarchy_path)
@@ -1,36 +1,72 @@
 import pandas as pd
 import numpy as np
-import datetime, copy, os
-from nf_covid.utils.utils import get_core_ref, roots
+import copy, os
+from nf_covid.utils.utils import get_core_ref, read_input, write_output, compression_ext, roots
+
+# Expected layout of each stage_1 long COVID input: id columns (which
+# together with draws must be unique) and, for inputs with several
+# measures stacked in the 'variable' column, the measures expected
+SCHEMAS = {
+    'midmod' : {'id_cols' : ['location_id', 'age_group_id', 'sex_id', 'date'], 
+                'msre' : None},
+    'hsp_admit' : {'id_cols' : ['location_id', 'age_group_id', 'sex_id', 'date', 'variable'], 
+                   'msre' : ['hospital_inc', 'hospital_deaths']},
+    'icu_admit' : {'id_cols' : ['location_id', 'age_group_id', 'sex_id', 'date', 'variable'], 
+                   'msre' : ['icu_inc', 'icu_deaths']}
+    }
+
 
 class Dataset():
-    def __init__(self, loc_id, loc_name, output_version, dst_type, nf_type):
+    def __init__(self, loc_id, loc_name, output_version, dst_type, nf_type, data=None, 
+                 date_window=None, sparse=False, shift_uses=None, year_windows=None):
 
         def init_data(self):
             ''' Collect input data '''
             if self.nf_type == 'short' :
                 if self.dataset_type in ['infections', 'deaths']:
-                    df = pd.read_csv('{}daily_{}.csv'.format(roots['infect_death_input_path'], 
-                                                             self.dataset_type))
+                    df = read_input('{}daily_{}.csv'.format(roots['infect_death_input_path'], 
+                                                            self.dataset_type))
                 elif self.dataset_type in ['hospital_admit', 'icu_admit']:
-                    df = pd.read_csv('{}{}_{}/{}.csv'.format(roots['hsp_icu_input_path'], 
-                                                             self.loc_name, self.loc_id, 
-                                                             self.dataset_type))
+                    df = read_input('{}{}_{}/{}.csv'.format(roots['hsp_icu_input_path'], 
+                                                            self.loc_name, self.loc_id, 
+                                                            self.dataset_type))
             else :
-                df = pd.read_csv('{}{}/stage_1/_for_long_covid/{}_{}_{}.csv'.format(get_core_ref('data_output', 'stage_1'), 
-                                                                                    self.output_version,
-                                                                                    self.loc_name, self.loc_id, 
-                                                                                    self.dataset_type))
+                df = read_input('{}{}/stage_1/_for_long_covid/{}_{}_{}.csv'.format(get_core_ref('data_output', 'stage_1'), 
+                                                                                   self.output_version,
+                                                                                   self.loc_name, self.loc_id, 
+                                                                                   self.dataset_type))
                 
+            # Input size (rows x draws), used to calibrate resource requests
+            self.draws = [c for c in df.columns if str(c).startswith('draw_')]
+            self.input_cells = len(df) * len(self.draws)
+
+            # Check the input before any reshaping
+            if self.nf_type == 'long' and self.dataset_type in SCHEMAS:
+                self.validate(df)
+
             # Make dates
-            df.date = [datetime.date(int(d.split('-')[0]),
-                                     int(d.split('-')[1]),
-                                     int(d.split('-')[2])) 
-                       for d in df.date]
-            df.date = pd.to_datetime(df.date)
+            df.date = pd.to_datetime(df.date, format='%Y-%m-%d')
+
+            # Drop dates outside the window before reshaping
+            if self.date_window is not None:
+                df = df[(df.date >= self.date_window[0]) & 
+                        (df.date <= self.date_window[1])]
             
             # Reshape long if nf_type is long_covid
             if self.nf_type == 'long':
+                # Dates covered, as zero rows are dropped below
+                self.dates = (df.date.min(), df.date.max())
+
+                # Drop wide rows before reshaping, so the melted frames scale 
+                # with nonzero volume. Keys of stacked measures are kept if 
+                # any of their measures is nonzero, so the unstack stays whole.
+                if self.sparse:
+                    nonzero = (df[self.draws] != 0).any(axis=1)
+                    if self.dataset_type != 'midmod':
+                        nonzero = nonzero.groupby([df.location_id, df.age_group_id, 
+                                                   df.sex_id, df.date]).transform('any')
+                    df = df[nonzero]
+
                 if self.dataset_type == 'midmod':
                     df = df.melt(id_vars=['location_id', 'age_group_id', 
                                           'sex_id', 'date'])
@@ -60,6 +96,11 @@ class Dataset():
                     df = df.drop(columns='value')
                     df = df.droplevel('msre', axis=1)
                     df = df.rename(columns={'variable' : 'draw_var'})
+
+                # Drop rows that are zero in every value column
+                if self.sparse:
+                    value_cols = [c for c in df.columns if c not in self.keys]
+                    df = df[(df[value_cols] != 0).any(axis=1)]
             
             return(df.reset_index(drop=True))
 
@@ -69,8 +110,214 @@ class Dataset():
         self.output_version = str(output_version)
         self.dataset_type = str(dst_type)
         self.nf_type = str(nf_type)
+        self.date_window = date_window
+        self.year_windows = year_windows
+        self.sparse = bool(sparse)
+        self.keys = ['location_id', 'age_group_id', 'sex_id', 'draw_var', 'date']
+        self.shifts = {}
+        self.shift_uses = dict(shift_uses) if shift_uses is not None else {}
+        self.input_cells = None
+        self.draws = None
+        self.dates = None
+
+        # Data may be supplied directly (e.g. aggregates built in memory)
+        if data is None:
+            self.data = init_data(self)
+        else:
+            self.data = data.reset_index(drop=True)
+
+
+    def validate(self, df):
+        ''' Check a raw input against its schema: columns and dtypes, draw 
+            columns, location / age / sex / measure values, key uniqueness, 
+            a complete daily date range overlapping date_window and dates for
+            every year in year_windows (year to the input dates its outputs 
+            come from). All checks are run, then any issues are written out 
+            together and raised. '''
+        schema = SCHEMAS[self.dataset_type]
+        issues = []
+        def report(check, n, detail=''):
+            if n:
+                issues.append({'check' : check, 'n' : int(n), 'detail' : str(detail)})
+
+        # Columns
+        missing = [c for c in schema['id_cols'] if c not in df.columns]
+        report('missing columns', len(missing), ', '.join(missing))
+        draws = [c for c in df.columns if str(c).startswith('draw_')]
+        report('no draw columns', len(draws) == 0)
+        extra = [c for c in df.columns if c not in schema['id_cols'] + draws]
+        report('unexpected columns', len(extra), ', '.join(map(str, extra)))
+
+        if draws:
+            # Draws numbered 0..n-1 and numeric without missing values
+            nums = pd.to_numeric(pd.Series(draws).str[5:], errors='coerce')
+            gaps = sorted(set(range(len(draws))) - set(nums.dropna().astype(int)))
+            report('missing draw columns', len(gaps), ', '.join('draw_{}'.format(i) for i in gaps[:10]))
+            bad = [c for c in draws if not pd.api.types.is_numeric_dtype(df[c])]
+            report('non-numeric draw columns', len(bad), ', '.join(bad[:10]))
+            numeric = [c for c in draws if c not in bad]
+            report('missing draw values', df[numeric].isnull().values.sum())
+
+        if missing:
+            self.report_issues(issues)
+
+        # Ids
+        for col, expected in [('location_id', [self.loc_id]), 
+                              ('age_group_id', roots['age_groups']), 
+                              ('sex_id', [1, 2])]:
+            if not pd.api.types.is_integer_dtype(df[col]):
+                report('non-integer {}'.format(col), 1, df[col].dtype)
+                continue
+            values = df[col][~df[col].isin(expected)]
+            report('unexpected {}'.format(col), len(values), 
+                   ', '.join(map(str, values.unique()[:10])))
+            present = set(df[col].unique())
+            absent = [v for v in expected if v not in present]
+            report('absent {}'.format(col), len(absent), ', '.join(map(str, absent)))
+
+        # Measures
+        if schema['msre'] is not None:
+            values = df.variable[~df.variable.isin(schema['msre'])]
+            report('unexpected msre', len(values), ', '.join(map(str, values.unique()[:10])))
+            present = set(df.variable.unique())
+            absent = [m for m in schema['msre'] if m not in present]
+            report('absent msre', len(absent), ', '.join(absent))
+
+        # Keys, marking repeats of an earlier key (reused to count unique keys)
+        dup = df.duplicated(schema['id_cols'])
+        dups = df.loc[dup, schema['id_cols']]
+        report('duplicated keys', len(dups), 
+               dups.drop_duplicates().head(5).to_dict('records'))
+
+        # Dates
+        dates = pd.to_datetime(df.date, format='%Y-%m-%d', errors='coerce')
+        report('unparseable dates', dates.isnull().sum(), 
+               ', '.join(map(str, df.date[dates.isnull()].unique()[:10])))
+        dates = dates.dropna()
+        if len(dates):
+            first, last = dates.min(), dates.max()
+            n_dates = (last - first).days + 1
+            gaps = pd.date_range(first, last).difference(dates.unique())
+            report('missing dates', len(gaps), ', '.join(gaps[:10].strftime('%Y-%m-%d')))
+
+            # Every key must have every date
+            n_keys = len(df[[c for c in schema['id_cols'] if c != 'date']].drop_duplicates())
+            report('missing key / date rows', max(n_keys * n_dates - (len(df) - int(dup.sum())), 0))
+
+            if self.date_window is not None:
+                report('no dates in window', (last < self.date_window[0]) or (first > self.date_window[1]), 
+                       '{:%Y-%m-%d} to {:%Y-%m-%d} outside {:%Y-%m-%d} to {:%Y-%m-%d}'.format(
+                           first, last, *self.date_window))
+
+            # Years the input cannot produce outputs for
+            if self.year_windows is not None:
+                missing = [y for y, (start, end) in self.year_windows.items() 
+                           if last < start or first > end]
+                report('no dates for years', len(missing), 
+                       '{} (input dates {:%Y-%m-%d} to {:%Y-%m-%d})'.format(
+                           ', '.join(map(str, missing)), first, last))
+
+        if issues:
+            self.report_issues(issues)
+
+
+    def report_issues(self, issues):
+        ''' Write input validation issues to the errors directory and raise '''
+        pd.DataFrame(issues).to_csv('{}{}/nf_covid_{}/errors/{}_cov_{}_{}_input_errors.csv'.format(roots['jobmon_logs_base'], self.output_version.split('.')[0], 
+                                                                                                self.output_version, self.nf_type, self.loc_id, self.dataset_type),
+                                    index=False)
+        raise ValueError('{} input failed validation: {}'.format(
+            self.dataset_type, '; '.join('{} ({})'.format(i['check'], i['n']) for i in issues)))
+
+
+    @classmethod
+    def submit(cls, executor, *args, **kwargs):
+        ''' Submit Dataset construction to an executor (e.g. a thread pool) 
+            so several inputs can load concurrently. Returns a future. '''
+        return(executor.submit(cls, *args, **kwargs))
+
+
+    def draw_index(self, draws, df=None):
+        ''' Integer position of each row's draw_var within draws, used to 
+            broadcast per-draw vectors along the draw axis without merging '''
+        if df is None:
+            df = self.data
+        idx = pd.Index(draws).get_indexer(df.draw_var)
+        if (idx < 0).any():
+            raise ValueError('draw_var values not found in supplied draws')
+        return(idx)
+
+
+    def shift(self, calc_cols, days, cache=False):
+        ''' Copy of the id columns and calc_cols with dates shifted forward by
+            days. With cache=True the result is kept while shift_uses (the 
+            planned number of uses of each (calc_cols, days), e.g. across 
+            scenarios) has uses left, so repeated lags are only built once 
+            and dropped after their last use. '''
+        if isinstance(calc_cols, str):
+            calc_cols = [calc_cols]
+        key = (tuple(calc_cols), days)
+        if key in self.shifts:
+            df = self.shifts[key]
+        else:
+            df = self.data[self.keys + calc_cols].copy()
+            df.date = df.date + pd.to_timedelta(days, unit='D')
+
+        if cache:
+            remaining = self.shift_uses.get(key, 0) - 1
+            if remaining > 0:
+                self.shift_uses[key] = remaining
+                self.shifts[key] = df
+            else:
+                self.shift_uses.pop(key, None)
+                self.shifts.pop(key, None)
+        return(df)
+
 
-        self.data = init_data(self)
+    def merge_shifted(self, lags, drop=None, cache=False):
+        ''' Merge data with shifted copies of other datasets' calc columns.
+            Dense data is left merged, leaving missing values where a shifted
+            copy has no date. In sparse data absent rows are zeros, so the 
+            merge is outer and zero filled, limited to the dates every input
+            covers (rows outside them would be missing in the dense merge).
+        Arguments:
+            lags : list
+                (Dataset, calc_cols, days) for each shifted copy
+            drop : list (optional)
+                Columns of data to leave out
+            cache : bool
+        '''
+        df = self.data if drop is None else self.data.drop(columns=drop)
+        if not self.sparse:
+            for ds, calc_cols, days in lags:
+                df = pd.merge(df, ds.shift(calc_cols, days, cache=cache), 
+                              how='left', on=self.keys)
+            return(df)
+
+        start, end = self.dates
+        for ds, calc_cols, days in lags:
+            df = pd.merge(df, ds.shift(calc_cols, days, cache=cache), 
+                          how='outer', on=self.keys)
+            start = max(start, ds.dates[0] + pd.to_timedelta(days, unit='D'))
+            end = min(end, ds.dates[1] + pd.to_timedelta(days, unit='D'))
+
+        df = df[(df.date >= start) & (df.date <= end)]
+        value_cols = [c for c in df.columns if c not in self.keys]
+        df[value_cols] = df[value_cols].fillna(0)
+        return(df.reset_index(drop=True))
+
+
+    def complete(self, grid, fill_value=0):
+        ''' Reindex data onto every combination of the grid's values, adding
+            the rows dropped from sparse data
+        Arguments:
+            grid : dict
+                Column name to its expected values
+            fill_value : float
+        '''
+        index = pd.MultiIndex.from_product(list(grid.values()), names=list(grid.keys()))
+        self.data = (self.data.set_index(list(grid.keys()))
+                     .reindex(index, fill_value=fill_value).reset_index())
 
 
     def collapse(self, agg_function='sum', group_cols=None, calc_cols=None):
@@ -135,14 +382,106 @@ class Dataset():
         self.data = orig
         
         
-    def save_data(self, output_cols, filename, stage):
-        ''' Save out dataset and run diagnostics '''
+    def check_square(self, df=None, name='data', ages=None, sexes=None, draws=None):
+        ''' Check that every expected age_group_id / sex_id / draw cell is 
+            present exactly once. Keys are integer coded and counted with a 
+            single bincount instead of merging against a full template. 
+            Expected ages / sexes default to the most-detailed ones and 
+            draws to the input's draw columns. '''
+        if df is None:
+            df = self.data
+        if draws is None:
+            draws = self.draws
+        if draws is None:
+            raise ValueError('Expected draws are required to check {} is square'.format(name))
+
+        ages = np.asarray(roots['age_groups'] if ages is None else ages, dtype=np.int64)
+        sexes = np.asarray([1, 2] if sexes is None else sexes, dtype=np.int64)
+        draws = np.asarray(draws)
+        # Unknown and missing draws are coded -1, like unexpected ages / sexes
+        draw_idx = pd.Index(draws).get_indexer(df.draw_var)
+
+        # Lookup tables from id to position, -1 marks unexpected ids
+        def encode(values, expected):
+            values = np.asarray(values, dtype=np.int64)
+            lookup = np.full(max(expected.max(), values.max(initial=0)) + 1, -1)
+            lookup[expected] = np.arange(len(expected))
+            codes = np.full(len(values), -1)
+            valid = values >= 0
+            codes[valid] = lookup[values[valid]]
+            return(codes)
+
+        age_idx = encode(df.age_group_id, ages)
+        sex_idx = encode(df.sex_id, sexes)
+
+        unexpected = (age_idx < 0) | (sex_idx < 0) | (draw_idx < 0)
+        n_cells = len(ages) * len(sexes) * len(draws)
+        flat = (age_idx * len(sexes) + sex_idx) * len(draws) + draw_idx
+        counts = np.bincount(flat[~unexpected], minlength=n_cells)
+
+        bad = np.flatnonzero(counts != 1)
+        if unexpected.any() or len(bad) > 0:
+            age_pos, rem = np.divmod(bad, len(sexes) * len(draws))
+            sex_pos, draw_pos = np.divmod(rem, len(draws))
+            issues = pd.DataFrame({'age_group_id' : ages[age_pos], 
+                                   'sex_id' : sexes[sex_pos], 
+                                   'draw_var' : draws[draw_pos], 
+                                   'count' : counts[bad]})
+            issues.to_csv('{}{}/nf_covid_{}/errors/{}_cov_{}_{}_square_errors.csv'.format(roots['jobmon_logs_base'], self.output_version.split('.')[0], 
+                                                                                          self.output_version, self.nf_type, self.loc_id, name),
+                          index=False)
+            raise ValueError('{} is not square: {} missing cells, {} duplicated cells, {} rows with unexpected age/sex/draw'.format(
+                name, int((counts == 0).sum()), int((counts > 1).sum()), int(unexpected.sum())))
+
+
+    def summarize_draws(self, df, calc_cols, group_cols=None, lower=0.025, upper=0.975):
+        ''' Calculate the mean and uncertainty interval of calc_cols across 
+            draws for each group. Draws are reshaped onto their own axis so 
+            quantiles are taken in one vectorized pass rather than per group. '''
+        if group_cols is None:
+            group_cols = [c for c in ['location_id', 'year_id', 'age_group_id', 'sex_id'] 
+                          if c in df.columns]
+        if isinstance(calc_cols, str):
+            calc_cols = [calc_cols]
+
+        # Order rows so each group's draws are contiguous
+        df = df.sort_values(group_cols + ['draw_var'])
+        keys = df[group_cols].drop_duplicates().reset_index(drop=True)
+        n_draws = len(df) // max(len(keys), 1)
+
+        if len(keys) * n_draws == len(df):
+            # (groups, draws, cols) array - quantiles along the draw axis
+            vals = df[calc_cols].to_numpy(dtype=float).reshape(len(keys), n_draws, 
+                                                                len(calc_cols))
+            mean = vals.mean(axis=1)
+            lo, hi = np.quantile(vals, [lower, upper], axis=1)
+        else:
+            # Uneven draws per group, fall back to grouped quantiles
+            g = df.groupby(group_cols, sort=True)[calc_cols]
+            mean = g.mean().to_numpy()
+            lo = g.quantile(lower).to_numpy()
+            hi = g.quantile(upper).to_numpy()
+
+        for i, col in enumerate(calc_cols):
+            keys['{}_mean'.format(col)] = mean[:, i]
+            keys['{}_lower'.format(col)] = lo[:, i]
+            keys['{}_upper'.format(col)] = hi[:, i]
+
+        return(keys)
+
+
+    def save_data(self, output_cols, filename, stage, compression=None, ages=None, 
+                  sexes=None, draws=None):
+        ''' Save out dataset and run diagnostics. compression may be 'gzip' 
+            or 'zstd' to write a compressed csv. ages / sexes are the expected
+            age_group_ids / sex_ids if not the most-detailed ones, draws the
+            expected draw_var values if not the input's draws. '''
 
         df = self.data[output_cols]
         
 
         # Check for squareness
-        
+        self.check_square(df, name=filename, ages=ages, sexes=sexes, draws=draws)
         
         # Pull output filepath
         out_loc = '{}{}/{}/{}_{}/'.format(get_core_ref('data_output', stage), 
@@ -156,17 +495,14 @@ class Dataset():
         
         
         # Output csv
-        df.to_csv('{}{}.csv'.format(out_loc, filename), index=False)
-        
-        
-        
-        
-        
-        
-        
-        
-        
-        
-        
-        
-        
\ No newline at end of file
+        write_output(df, '{}{}.csv{}'.format(out_loc, filename, compression_ext.get(compression, '')), 
+                     compression=compression)
+
+
+        # Draw summaries (mean, 95% UI) by age / sex
+        id_cols = ['location_id', 'year_id', 'age_group_id', 'sex_id', 'draw_var']
+        summary = self.summarize_draws(df, calc_cols=[c for c in output_cols 
+                                                      if c not in id_cols])
+        write_output(summary, '{}diagnostics/{}_summary.csv{}'.format(out_loc, filename, 
+                                                                      compression_ext.get(compression, '')), 
+                     compression=compression)
@@ -0,0 +1,339 @@
+'''
+    Script: estimate_resources.py
+    Author: Kyle Simpson
+
+    Description:
+        Predicts the peak memory and runtime of 6_long_covid.py for a location
+        from the size of its stage_1 inputs, so the parent launcher can request
+        right-sized jobs instead of a flat 25GB / 24 hours.
+
+    Notes:
+        Only the start of each input is read - no parsing. The number of rows
+        is estimated from the file's uncompressed size (the file size, the
+        gzip size trailer, or the zstd frame header or compression ratio) and
+        the mean line length of the first chunk. The size of a location is measured in input cells
+        (rows x draw columns summed over midmod, hsp_admit and icu_admit), 
+        which is what the melted frames in main() scale with.
+
+        6_long_covid.py writes the runtime and peak memory of each of its
+        stages to its own file in a shared runs directory (see record_run),
+        so concurrent jobs never append to the same file. Each stage is 
+        modelled as a linear function of input cells fit to those recorded 
+        runs, padded by the largest under-prediction seen in calibration. 
+        Until a stage has enough recorded runs the flat defaults are used, 
+        without any margin.
+
+        Runs also record the main() options that change their work (years,
+        sparse, parallel, param_draws, compression), and models are only fit
+        to runs with the options being requested. Fitting reads every runs
+        file, so launchers should call load_model once and pass the model to
+        get_qsub_flags for each location.
+'''
+
+from nf_covid.utils.utils import get_core_ref, find_input, roots
+import datetime, glob, gzip, math, os, resource, socket, time, zlib
+import numpy as np
+import pandas as pd
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+
+STAGES = ['load', 'severities', 'aggregate', 'save']
+INPUTS = ['midmod', 'hsp_admit', 'icu_admit']
+
+# Current flat request, used until a stage is calibrated
+DEFAULT_MEM_GB = 25
+DEFAULT_RUNTIME_S = 24 * 60 * 60
+
+
+def get_runs_dir():
+    ''' Location of the shared directory of recorded runs '''
+    return('{}resources/long_covid_runs/'.format(roots['jobmon_logs_base']))
+
+
+def peak_mem_gb():
+    ''' Peak resident memory of this process so far, in GB (Linux reports KB) '''
+    return(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024**2)
+
+
+class StageTimer():
+    ''' Records the runtime and peak memory of consecutive pipeline stages '''
+    def __init__(self):
+        self.stages = []
+        self.start = time.perf_counter()
+
+
+    def stop(self, stage):
+        ''' Close the current stage and start timing the next one '''
+        now = time.perf_counter()
+        self.stages.append({'stage' : stage,
+                            'runtime_s' : now - self.start,
+                            'peak_mem_gb' : peak_mem_gb()})
+        self.start = now
+
+
+def get_run_options(years=None, sparse=False, parallel=False, param_draws=None, 
+                    compression=None):
+    ''' The main() options that change a run's work, as recorded with its 
+        timings. Arguments match main(). '''
+    if param_draws is None:
+        draws = 'mean'
+    elif isinstance(param_draws, str) and param_draws == 'sample':
+        draws = 'sample'
+    else:
+        draws = 'table'
+    return({'years' : '-'.join(map(str, sorted(years if years is not None else [2020]))), 
+            'sparse' : str(bool(sparse)), 'parallel' : str(bool(parallel)), 
+            'param_draws' : draws, 'compression' : str(compression)})
+
+
+def record_run(loc_id, output_version, cells, timer, options=None):
+    ''' Write a run's stage timings to its own file in the runs directory 
+        used for calibration
+    Arguments:
+        loc_id : int
+        output_version : str
+        cells : int
+            Input cells, as returned by get_input_cells
+        timer : StageTimer
+        options : dict (optional)
+            As returned by get_run_options, defaults to main()'s defaults
+    '''
+    runs = pd.DataFrame(timer.stages)
+    for col, value in (options if options is not None else get_run_options()).items():
+        runs[col] = value
+    runs.insert(0, 'cells', cells)
+    runs.insert(0, 'output_version', output_version)
+    runs.insert(0, 'location_id', loc_id)
+
+    runs_dir = get_runs_dir()
+    os.makedirs(runs_dir, exist_ok=True)
+    name = '{}_{}_{}_{}_{}.csv'.format(loc_id, output_version, socket.gethostname(), 
+                                       os.getpid(), 
+                                       datetime.datetime.now().strftime('%Y%m%d%H%M%S%f'))
+
+    # Write then rename so readers never see a partial file
+    tmp = os.path.join(runs_dir, '.{}'.format(name))
+    runs.to_csv(tmp, index=False)
+    os.rename(tmp, os.path.join(runs_dir, name))
+
+
+def read_runs():
+    ''' All recorded runs, or None if there are none '''
+    paths = glob.glob(os.path.join(get_runs_dir(), '*.csv'))
+    if not paths:
+        return(None)
+    # Options are read back as recorded (e.g. 'None' not as missing)
+    options = {col : str for col in get_run_options()}
+    return(pd.concat([pd.read_csv(p, dtype=options, keep_default_na=False) for p in paths], 
+                     ignore_index=True))
+
+
+def open_input(path):
+    ''' Open a (possibly compressed) input as a binary stream '''
+    if pa is not None:
+        return(pa.input_stream(path, compression='detect'))
+    if path.endswith('.gz'):
+        return(gzip.open(path, 'rb'))
+    if path.endswith('.zst'):
+        raise ImportError('pyarrow is required to read zstd compressed inputs.')
+    return(open(path, 'rb'))
+
+
+def get_zstd_content_size(path):
+    ''' Uncompressed size from a zstd frame header, or None if the writer did
+        not record it (or the file has several frames) '''
+    with open(path, 'rb') as f:
+        head = f.read(18)
+    if len(head) < 6 or int.from_bytes(head[:4], 'little') != 0xFD2FB528:
+        return(None)
+
+    descriptor = head[4]
+    fcs_flag, single_segment, dict_flag = descriptor >> 6, (descriptor >> 5) & 1, descriptor & 3
+    fcs_size = [1 if single_segment else 0, 2, 4, 8][fcs_flag]
+    if fcs_size == 0:
+        return(None)
+
+    # Content size follows the window descriptor and dictionary id
+    start = 5 + (0 if single_segment else 1) + [0, 1, 2, 4][dict_flag]
+    size = int.from_bytes(head[start:start + fcs_size], 'little')
+    return(size + 256 if fcs_size == 2 else size)
+
+
+def get_uncompressed_size(path, sample_size=1024**2):
+    ''' Uncompressed size of an input in bytes, or None if it is only known
+        by reading the whole file
+    Arguments:
+        path : str
+        sample_size : int
+            Compressed bytes used to estimate the compression ratio
+    '''
+    size = os.path.getsize(path)
+    if path.endswith('.gz'):
+        # The trailer holds the size modulo 2**32, the compression ratio of
+        # the first block tells how many times it wrapped
+        with open(path, 'rb') as f:
+            raw = f.read(sample_size)
+            f.seek(-4, os.SEEK_END)
+            isize = int.from_bytes(f.read(4), 'little')
+        out = zlib.decompressobj(16 + zlib.MAX_WBITS).decompress(raw)
+        guess = size * len(out) / max(len(raw), 1)
+        return(isize + max(round((guess - isize) / 2**32), 0) * 2**32)
+    if path.endswith('.zst'):
+        content_size = get_zstd_content_size(path)
+        if content_size is not None or pa is None:
+            return(content_size)
+        # Streamed frames have no size, so scale by the first block's ratio
+        raw = pa.OSFile(path)
+        with pa.CompressedInputStream(raw, 'zstd') as f:
+            out = len(f.read(sample_size * 4))
+            consumed = raw.tell()
+        return(round(size * out / max(consumed, 1)))
+    return(size)
+
+
+def get_input_dims(path, chunk_size=4 * 1024**2):
+    ''' Number of data rows and draw columns of a csv. Only the first chunk
+        is read; rows are estimated from the uncompressed size and the mean
+        line length of that chunk. Files whose size is unknown (or that fit
+        in one chunk) are counted exactly.
+    Arguments:
+        path : str
+        chunk_size : int
+    '''
+    path = find_input(path)
+    with open_input(path) as f:
+        chunk = f.read(chunk_size)
+        header = chunk.split(b'\n', 1)[0]
+        n_draws = sum(c.strip().strip('"').startswith('draw_') 
+                      for c in header.decode().split(','))
+
+        # Estimate from whole lines after the header
+        size = get_uncompressed_size(path) if len(chunk) == chunk_size else None
+        lines = chunk[len(header) + 1:chunk.rfind(b'\n') + 1]
+        n_lines = lines.count(b'\n')
+        if size is not None and n_lines > 0:
+            return(round((size - len(header) - 1) / (len(lines) / n_lines)), n_draws)
+
+        # Count lines chunk by chunk, less the header
+        n_rows = -1
+        last = chunk
+        while chunk:
+            n_rows += chunk.count(b'\n')
+            last = chunk
+            chunk = f.read(chunk_size)
+        # Count a final line without a trailing newline
+        if last and not last.endswith(b'\n'):
+            n_rows += 1
+
+    return(n_rows, n_draws)
+
+
+def get_input_cells(loc_id, loc_name, output_version):
+    ''' Total input cells (rows x draws) across a location's stage_1 inputs
+    Arguments:
+        loc_id : int
+        loc_name : str
+        output_version : str
+    '''
+    cells = 0
+    for dst_type in INPUTS:
+        n_rows, n_draws = get_input_dims('{}{}/stage_1/_for_long_covid/{}_{}_{}.csv'.format(get_core_ref('data_output', 'stage_1'),
+                                                                                             output_version,
+                                                                                             loc_name, loc_id,
+                                                                                             dst_type))
+        cells += n_rows * n_draws
+    return(cells)
+
+
+def fit_model(runs, options=None, min_runs=5):
+    ''' Fit runtime and peak memory against input cells for each stage, 
+        using only runs made with the same options
+    Arguments:
+        runs : Pandas DataFrame
+            Recorded runs, as written by record_run
+        options : dict (optional)
+            As returned by get_run_options, defaults to main()'s defaults
+        min_runs : int
+            Stages with fewer recorded runs are left uncalibrated
+    '''
+    model = {}
+    for col, value in (options if options is not None else get_run_options()).items():
+        # Runs recorded before the option was, can't be matched
+        if col not in runs.columns:
+            return(model)
+        runs = runs[runs[col].astype(str) == value]
+    for stage, g in runs.groupby('stage'):
+        if len(g) < min_runs or g.cells.nunique() < 2:
+            continue
+        for col in ['runtime_s', 'peak_mem_gb']:
+            slope, intercept = np.polyfit(g.cells, g[col], 1)
+            resid = g[col] - (intercept + slope * g.cells)
+            model[(stage, col)] = (intercept, slope, max(resid.max(), 0))
+    return(model)
+
+
+def predict(cells, model, margin=1):
+    ''' Predicted runtime and peak memory of each stage. Uncalibrated stages 
+        get the flat defaults as they are.
+    Arguments:
+        cells : int
+        model : dict
+            As returned by fit_model
+        margin : float
+            Multiplier applied to calibrated predictions
+    '''
+    rows = []
+    for stage in STAGES:
+        row = {'stage' : stage}
+        for col, default in [('runtime_s', DEFAULT_RUNTIME_S / len(STAGES)),
+                             ('peak_mem_gb', DEFAULT_MEM_GB)]:
+            if (stage, col) in model:
+                intercept, slope, pad = model[(stage, col)]
+                row[col] = (max(intercept + slope * cells, 0) + pad) * margin
+            else:
+                row[col] = default
+        rows.append(row)
+    return(pd.DataFrame(rows))
+
+
+def load_model(options=None):
+    ''' Fit a model to all recorded runs with the given options (see 
+        fit_model). Reads every runs file, so call once per launch. '''
+    runs = read_runs()
+    return(fit_model(runs, options=options) if runs is not None else {})
+
+
+def get_qsub_flags(loc_id, loc_name, output_version, model=None, margin=1.2, threads=4):
+    ''' Suggested scheduler resource flags for a location's long COVID job
+    Arguments:
+        loc_id : int
+        loc_name : str
+        output_version : str
+        model : dict (optional)
+            As returned by load_model, loaded for default options if not given
+        margin : float
+            Multiplier applied on top of calibrated predictions
+        threads : int
+    '''
+    if model is None:
+        model = load_model()
+    pred = predict(get_input_cells(loc_id, loc_name, output_version), model, margin=margin)
+
+    # Memory is the peak over stages, runtime is the sum of stages
+    mem = math.ceil(pred.peak_mem_gb.max())
+    runtime = math.ceil(pred.runtime_s.sum())
+
+    return('-l fthread={} -l m_mem_free={}G -l h_rt={:02d}:{:02d}:{:02d}'.format(
+        threads, max(mem, 1), runtime // 3600, runtime % 3600 // 60, runtime % 60))
+
+
+if __name__ == '__main__':
+    loc_id = 160
+    loc_name='Afghanistan'
+    output_version='2021-02-04.01'
+
+    model = load_model()
+    print(get_qsub_flags(loc_id, loc_name, output_version, model=model))
@@ -0,0 +1,257 @@
+'''
+    Script: worker.py
+    Author: Kyle Simpson
+
+    Description:
+        Long-lived worker that runs 6_long_covid.py for many locations in one
+        process. Imports, refs.yaml / roots and the proportions / durations 
+        and disability weight tables stay warm between jobs, so small 
+        locations no longer pay start-up costs that outweigh their compute.
+
+    Notes:
+        Jobs are taken from a directory spool with the layout
+
+            <spool>/queue/    job files waiting to run
+            <spool>/running/  jobs claimed by a worker, in a directory
+                              per worker named <host>_<pid>
+            <spool>/done/     finished jobs, with their status
+            <spool>/failed/   failed jobs, with their status and traceback
+
+        A job is a json file of main() arguments (loc_id, loc_name and
+        output_version are required). Workers claim jobs by renaming them
+        into their directory in running/, so several workers can share one
+        spool. Each job's file is rewritten with its status, worker, timings
+        and (on failure) traceback before being moved to done/ or failed/.
+
+        Workers touch a heartbeat file in their running/ directory while 
+        they are alive. Claims of a worker that has died (its pid is gone on
+        this host, or its heartbeat is older than stale_s) are put back in
+        the queue by the other workers, up to max_requeues times before the
+        job is filed as failed.
+
+        A worker exits after max_jobs jobs (or idle_exit_s seconds without
+        work) so the launcher can start a fresh one, bounding memory growth.
+        Resource recording is off by default, as peak memory is measured
+        over the life of the process rather than per job.
+'''
+
+from nf_covid.utils.utils import roots
+import datetime, gc, glob, importlib, json, os, socket, threading, time, traceback
+
+long_covid = importlib.import_module('6_long_covid')
+
+SPOOL_DIRS = ['queue', 'running', 'done', 'failed']
+HEARTBEAT = '.heartbeat'
+
+
+def get_worker_name():
+    ''' Name of this worker, and of its directory in running/ '''
+    return('{}_{}'.format(socket.gethostname(), os.getpid()))
+
+
+def queued_at(path):
+    ''' Submission timestamp of a job, from its file name '''
+    return(os.path.basename(path).rsplit('_', 1)[-1])
+
+
+def write_job(spool_dir, job, name, dest):
+    ''' Write a job into dest/ of the spool, writing then renaming so workers
+        never see a partial file '''
+    tmp = os.path.join(spool_dir, '.{}'.format(name))
+    with open(tmp, 'w') as f:
+        json.dump(job, f, indent=2)
+    os.rename(tmp, os.path.join(spool_dir, dest, name))
+
+
+def submit_job(spool_dir, loc_id, loc_name, output_version, **kwargs):
+    ''' Add a location job to the spool queue
+    Arguments:
+        spool_dir : str
+        loc_id : int
+        loc_name : str
+        output_version : str
+        kwargs : dict
+            Any other main() arguments
+    '''
+    for d in SPOOL_DIRS:
+        os.makedirs(os.path.join(spool_dir, d), exist_ok=True)
+
+    job = dict(kwargs, loc_id=int(loc_id), loc_name=str(loc_name),
+               output_version=str(output_version))
+    name = '{}_{}_{}.json'.format(output_version, loc_id,
+                                  datetime.datetime.now().strftime('%Y%m%d%H%M%S%f'))
+
+    write_job(spool_dir, job, name, 'queue')
+    return(name)
+
+
+def claim_job(spool_dir):
+    ''' Claim the oldest queued job, returning its path in this worker's 
+        running/ directory (or None) '''
+    # Ordered by file name, as queued files may be claimed while sorting
+    for path in sorted(glob.glob(os.path.join(spool_dir, 'queue', '*.json')),
+                       key=queued_at):
+        claimed = os.path.join(spool_dir, 'running', get_worker_name(), 
+                               os.path.basename(path))
+        try:
+            os.rename(path, claimed)
+        except FileNotFoundError:
+            # Taken by another worker
+            continue
+        return(claimed)
+    return(None)
+
+
+def is_stale(worker_dir, stale_s):
+    ''' Whether the worker owning a running/ directory has died
+    Arguments:
+        worker_dir : str
+        stale_s : float
+    '''
+    host, pid = os.path.basename(worker_dir).rsplit('_', 1)
+    if host == socket.gethostname():
+        try:
+            os.kill(int(pid), 0)
+        except ProcessLookupError:
+            return(True)
+        except PermissionError:
+            # Alive, but owned by another user
+            pass
+    try:
+        return(time.time() - os.path.getmtime(os.path.join(worker_dir, HEARTBEAT)) > stale_s)
+    except FileNotFoundError:
+        # Claimed before its first heartbeat, or already cleaned up
+        return(False)
+
+
+def requeue_stale(spool_dir, stale_s, max_requeues):
+    ''' Put the jobs claimed by dead workers back in the queue 
+    Arguments:
+        spool_dir : str
+        stale_s : float
+        max_requeues : int
+    '''
+    for worker_dir in glob.glob(os.path.join(spool_dir, 'running', '*_*')):
+        if worker_dir.endswith(get_worker_name()) or not is_stale(worker_dir, stale_s):
+            continue
+        # Take the directory over first so only one worker requeues it
+        taken = os.path.join(spool_dir, 'running', '.stale_{}'.format(os.path.basename(worker_dir)))
+        try:
+            os.rename(worker_dir, taken)
+        except (FileNotFoundError, OSError):
+            continue
+
+        for path in glob.glob(os.path.join(taken, '*.json')):
+            with open(path) as f:
+                job = json.load(f)
+            job['_requeues'] = job.get('_requeues', 0) + 1
+            name = os.path.basename(path)
+            if job['_requeues'] > max_requeues:
+                print('Failing {}, its worker died {} times'.format(name, max_requeues + 1))
+                job['_status'] = {'status' : 'failed', 
+                                  'worker' : os.path.basename(worker_dir), 
+                                  'traceback' : 'Worker died while running the job'}
+                write_job(spool_dir, job, name, 'failed')
+            else:
+                print('Requeueing {} from dead worker {}'.format(name, os.path.basename(worker_dir)))
+                write_job(spool_dir, job, name, 'queue')
+            os.remove(path)
+
+        for path in glob.glob(os.path.join(taken, '*')) + glob.glob(os.path.join(taken, '.*')):
+            os.remove(path)
+        os.rmdir(taken)
+
+
+def heartbeat(worker_dir, interval_s, stop):
+    ''' Touch the worker's heartbeat file until stop is set '''
+    path = os.path.join(worker_dir, HEARTBEAT)
+    while not stop.is_set():
+        with open(path, 'a'):
+            os.utime(path)
+        stop.wait(interval_s)
+
+
+def run_job(spool_dir, path):
+    ''' Run a claimed job and file it under done/ or failed/ with its status '''
+    with open(path) as f:
+        job = json.load(f)
+
+    status = {'worker' : get_worker_name(),
+              'start' : datetime.datetime.now().isoformat()}
+    start = time.perf_counter()
+    print('Running {} ({}) {}...'.format(job['loc_name'], job['loc_id'], job['output_version']))
+
+    try:
+        kwargs = {k : v for k, v in job.items() if not k.startswith('_')}
+        kwargs.setdefault('record_resources', False)
+        long_covid.main(**kwargs)
+        status['status'] = 'done'
+    except Exception:
+        status['status'] = 'failed'
+        status['traceback'] = traceback.format_exc()
+        print(status['traceback'])
+
+    status['end'] = datetime.datetime.now().isoformat()
+    status['runtime_s'] = time.perf_counter() - start
+    print('  {} in {:.1f}s'.format(status['status'], status['runtime_s']))
+
+    with open(path, 'w') as f:
+        json.dump(dict(job, **{'_status' : status}), f, indent=2)
+    os.rename(path, os.path.join(spool_dir, status['status'], os.path.basename(path)))
+    return(status['status'])
+
+
+def main(spool_dir, max_jobs=50, poll_s=5, idle_exit_s=None, stale_s=600, 
+         max_requeues=2):
+    ''' Run jobs from the spool until max_jobs have run or the queue has been
+        empty for idle_exit_s seconds
+    Arguments:
+        spool_dir : str
+        max_jobs : int
+        poll_s : float
+        idle_exit_s : float (optional)
+        stale_s : float
+            Age of a heartbeat after which another worker's claims are requeued
+        max_requeues : int
+            Times a job is requeued after its worker dies before it fails
+    '''
+    for d in SPOOL_DIRS:
+        os.makedirs(os.path.join(spool_dir, d), exist_ok=True)
+    worker_dir = os.path.join(spool_dir, 'running', get_worker_name())
+    os.makedirs(worker_dir, exist_ok=True)
+
+    # Heartbeat on its own thread, as jobs can run for longer than stale_s
+    stop = threading.Event()
+    beat = threading.Thread(target=heartbeat, daemon=True,
+                            args=(worker_dir, min(poll_s, stale_s / 4), stop))
+    beat.start()
+
+    n_jobs = 0
+    idle_since = time.time()
+    while n_jobs < max_jobs:
+        requeue_stale(spool_dir, stale_s, max_requeues)
+        path = claim_job(spool_dir)
+        if path is None:
+            if idle_exit_s is not None and time.time() - idle_since > idle_exit_s:
+                break
+            time.sleep(poll_s)
+            continue
+
+        run_job(spool_dir, path)
+        n_jobs += 1
+        idle_since = time.time()
+
+        # Release the previous location's frames before the next job
+        gc.collect()
+
+    stop.set()
+    beat.join()
+    os.remove(os.path.join(worker_dir, HEARTBEAT))
+    os.rmdir(worker_dir)
+    print('Worker exiting after {} jobs'.format(n_jobs))
+
+
+if __name__ == '__main__':
+    spool_dir='{}long_covid_spool/'.format(roots['jobmon_logs_base'])
+
+    main(spool_dir)
@@ -2,15 +2,29 @@
     Name of Module: utils.py
     Contents:
         clean filepath
+        load_refs
         get_core_ref
         set_roots
+        find_input
+        read_input
+        check_compression
+        write_output
     Contributors: Kyle Simpson
 '''
 # Import packages
-import getpass, sys, yaml
+import functools, getpass, os, sys, yaml
+import pandas as pd
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+except ImportError:
+    pa = pa_csv = None
 
 nf_repo = ''
 
+# File extensions for supported compression methods
+compression_ext = {'gzip' : '.gz', 'zstd' : '.zst'}
+
 
 def clean_filepath(path):
     ''' Removes any bracketed items from filepaths
@@ -33,6 +47,19 @@ def clean_filepath(path):
     return(path)
 
 
+@functools.lru_cache(maxsize=None)
+def load_refs(path):
+    ''' Parses refs.yaml once per process. The result is shared, so callers 
+    must not modify it.
+
+    Arguments:
+        path : str
+            A string containing the path to refs.yaml.
+    '''
+    with open(path) as file:
+        return(yaml.full_load(file))
+
+
 def get_core_ref(param_name, sub_key=None):
     ''' Convenience function to pull static reference from refs.yaml.
 
@@ -47,8 +74,7 @@ def get_core_ref(param_name, sub_key=None):
         raise ValueError('Supplied param_name is None. You must supply a value.')
 
     # Pull reference
-    with open('{}refs.yaml'.format(nf_repo)) as file:
-        refs = yaml.full_load(file)
+    refs = load_refs('{}refs.yaml'.format(nf_repo))
     
     ref = ''
     if sub_key is None:
@@ -127,4 +153,74 @@ def set_roots():
     return(roots)
 
 
+def find_input(path):
+    ''' Returns path, or a gzip / zstd compressed copy of it if only that exists.
+
+    Arguments:
+        path : str
+            A string containing the uncompressed filepath.
+    '''
+    for ext in [''] + list(compression_ext.values()):
+        if os.path.exists(path + ext):
+            return(path + ext)
+
+    raise FileNotFoundError('No input found at {} (or compressed copies).'.format(path))
+
+
+def read_input(path, usecols=None):
+    ''' Reads a csv, transparently handling gzip / zstd compression. Uses the 
+    multi-threaded pyarrow reader when installed, so decompression overlaps 
+    parsing, and falls back to pandas otherwise. Dates are left as strings.
+
+    Arguments:
+        path : str
+            A string containing the uncompressed filepath.
+        usecols : list (optional)
+            A list of columns to read.
+    '''
+    path = find_input(path)
+
+    if pa_csv is not None:
+        convert = pa_csv.ConvertOptions(column_types={'date' : pa.string()},
+                                        include_columns=usecols or [])
+        return(pa_csv.read_csv(path, convert_options=convert).to_pandas())
+
+    return(pd.read_csv(path, usecols=usecols, dtype={'date' : str}))
+
+
+def check_compression(compression):
+    ''' Raises before any work is done if outputs can't be written with the
+    requested compression.
+
+    Arguments:
+        compression : str (optional)
+            None, 'gzip' or 'zstd'.
+    '''
+    if compression is not None and compression not in compression_ext:
+        raise ValueError('Unsupported compression {}.'.format(compression))
+    if compression == 'zstd' and pa is None:
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError('pyarrow or zstandard is required to write zstd compressed outputs.')
+
+
+def write_output(df, path, compression=None):
+    ''' Writes a csv without the index. zstd is written through pyarrow when
+    installed, as it is read, so the zstandard package isn't needed.
+
+    Arguments:
+        df : Pandas DataFrame
+        path : str
+            A string containing the full filepath, including any extension.
+        compression : str (optional)
+            None, 'gzip' or 'zstd'.
+    '''
+    if compression == 'zstd' and pa is not None:
+        with pa.output_stream(path, compression='zstd') as f:
+            df.to_csv(f, index=False)
+    else:
+        df.to_csv(path, index=False, compression=compression)
+
+
 roots = set_roots()
\ No newline at end of file